@@ -0,0 +1,258 @@
+'''
+A stand-in for the parts of the Confluence REST API that confluence2pelican uses, serving a
+synthetic space so slurp/export can be measured without a real Confluence.
+
+    python benchmarks/fake_confluence.py --pages 1000 --depth 4 --blogs 100 --latency 0.02
+
+Then point confluence_url at http://127.0.0.1:8090/ with confluence_space BENCH (any username
+and password are accepted). Page content is generated on request, so large spaces are cheap.
+'''
+import re
+import time
+import json
+import math
+import argparse
+import threading
+from urllib.parse import urlsplit, parse_qs, unquote
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class FakeSpace:
+    def __init__(self, key='BENCH', pages=1000, depth=4, blogs=100, attachments=1, attachment_size=10240, labels=2,
+                 max_limit=None):
+        self.key = key
+        self.page_count = max(1, pages)
+        self.blog_count = blogs
+        self.attachment_count = attachments
+        self.attachment_size = attachment_size
+        self.label_count = labels
+        self.max_limit = max_limit  # Like Confluence's system limits, caps the limit clients ask for
+        self.branching = max(2, math.ceil(self.page_count ** (1 / max(1, depth))))
+        self.versions = {}  # bump() these to simulate edits
+        self.lock = threading.Lock()
+
+    # Ids: pages are 1..page_count, blog posts follow them, attachments are 'att' + content id + index
+    def is_page(self, content_id):
+        return 1 <= content_id <= self.page_count
+
+    def is_blog(self, content_id):
+        return self.page_count < content_id <= self.page_count + self.blog_count
+
+    def parent(self, page_id):
+        return None if page_id == 1 else (page_id - 2) // self.branching + 1
+
+    def children(self, page_id):
+        first = (page_id - 1) * self.branching + 2
+        return [i for i in range(first, first + self.branching) if i <= self.page_count]
+
+    def ancestors(self, page_id):
+        ancestors = []
+        parent = self.parent(page_id)
+        while parent is not None:
+            ancestors.insert(0, parent)
+            parent = self.parent(parent)
+        return ancestors
+
+    def version(self, content_id):
+        return self.versions.get(content_id, 1)
+
+    def bump(self, content_id):
+        with self.lock:
+            self.versions[content_id] = self.version(content_id) + 1
+
+    def attachment_data(self, content_id, index):
+        seed = f'{content_id}:{index}:'.encode('utf-8')
+        return (seed * (self.attachment_size // len(seed) + 1))[:self.attachment_size]
+
+    def attachment_json(self, content_id, index):
+        title = f'file-{index}.bin'
+        return {
+            'id': f'att{content_id}{index:03d}',
+            'type': 'attachment',
+            'title': title,
+            'version': {'number': 1, 'when': '2020-01-01T00:00:00.000Z'},
+            'history': {'createdDate': '2020-01-01T00:00:00.000Z', 'createdBy': {'username': 'bench'}},
+            'extensions': {'fileSize': self.attachment_size, 'mediaType': 'application/octet-stream'},
+            '_links': {'download': f'/download/attachments/{content_id}/{title}?version=1&api=v2'}
+        }
+
+    def results(self, results, limit=200):
+        '''
+        An embedded expansion, cut off at limit like Confluence does (the rest is under child/...)
+        '''
+        return {'results': results[0:limit], 'size': min(limit, len(results)), 'limit': limit, 'start': 0}
+
+    def page_limit(self, params):
+        limit = int(params.get('limit', ['25'])[0])
+        return min(limit, self.max_limit) if self.max_limit else limit
+
+    def labels(self, content_id):
+        return [{'prefix': 'global', 'name': f'label-{n}'} for n in range(self.label_count)]
+
+    def attachments(self, content_id):
+        return [self.attachment_json(content_id, index) for index in range(self.attachment_count)]
+
+    def body(self, content_id):
+        parent = self.parent(content_id) if self.is_page(content_id) else 1
+        paragraphs = [
+            f'<p>Paragraph {n} of content {content_id}, see the '
+            f'<a href="/pages/viewpage.action?pageId={parent or 1}">parent page</a>.</p>'
+            for n in range(5)
+        ]
+        for index in range(self.attachment_count):
+            paragraphs.append(
+                f'<p><a data-linked-resource-id="{content_id}{index:03d}" data-linked-resource-type="attachment" '
+                f'href="/download/attachments/{content_id}/file-{index}.bin?version=1&amp;api=v2">file-{index}.bin</a></p>'
+            )
+        paragraphs.append(
+            '<pre class="syntaxhighlighter-pre" data-syntaxhighlighter-params="brush: py; gutter: false">'
+            f'print({content_id})</pre>'
+        )
+        return ''.join(paragraphs)
+
+    def content_json(self, content_id, expand=''):
+        is_page = self.is_page(content_id)
+        version = self.version(content_id)
+        content = {
+            'id': str(content_id),
+            'type': 'page' if is_page else 'blogpost',
+            'title': f'Page {content_id}' if is_page else f'Blog post {content_id}',
+            'version': {'number': version, 'when': f'2020-01-{min(28, version):02d}T00:00:00.000Z'},
+            'metadata': {'labels': self.results(self.labels(content_id))},
+            'children': {'attachment': self.results(self.attachments(content_id), limit=25)},
+        }
+        if is_page:
+            content['children']['page'] = self.results([
+                {'id': str(child), 'title': f'Page {child}'} for child in self.children(content_id)
+            ])
+            content['ancestors'] = [{'id': str(a)} for a in self.ancestors(content_id)]
+        if 'history' in expand:
+            content['history'] = {'createdDate': '2020-01-01T00:00:00.000Z', 'createdBy': {'username': 'bench'}}
+        if 'body.export_view' in expand:
+            content['body'] = {'export_view': {'value': self.body(content_id)}}
+        return content
+
+
+class Handler(BaseHTTPRequestHandler):
+    space = None
+    latency = 0.0
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def page_of(self, ids, params, expand):
+        start = int(params.get('start', ['0'])[0])
+        limit = self.space.page_limit(params)
+        chunk = ids[start:start + limit]
+        return {
+            'results': [self.space.content_json(i, expand) for i in chunk],
+            'start': start,
+            'limit': limit,
+            'size': len(chunk),
+            'totalSize': len(ids)
+        }
+
+    def do_GET(self):
+        if self.latency:
+            time.sleep(self.latency)
+        url = urlsplit(self.path)
+        params = parse_qs(url.query)
+        expand = params.get('expand', [''])[0]
+        space = self.space
+        blog_ids = list(range(space.page_count + 1, space.page_count + space.blog_count + 1))
+
+        if url.path == f'/rest/api/space/{space.key}':
+            return self.send_json({'key': space.key, 'homepage': {'id': '1'}})
+
+        if url.path == '/rest/api/content/search':
+            if 'blogpost' not in params.get('cql', [''])[0]:
+                return self.send_json(self.page_of([], params, expand))
+            return self.send_json(self.page_of(blog_ids, params, expand))
+
+        if url.path == '/rest/api/content':
+            if params.get('type', ['page'])[0] == 'blogpost':
+                ids = blog_ids
+            else:
+                ids = list(range(1, space.page_count + 1))
+            return self.send_json(self.page_of(ids, params, expand))
+
+        match = re.match(r'^/rest/api/content/(\d+)$', url.path)
+        if match:
+            content_id = int(match.group(1))
+            if not (space.is_page(content_id) or space.is_blog(content_id)):
+                return self.send_json({'message': 'not found'}, status=404)
+            return self.send_json(space.content_json(content_id, expand))
+
+        match = re.match(r'^/rest/api/content/(\d+)/(label|child/attachment)$', url.path)
+        if match:
+            content_id = int(match.group(1))
+            items = space.labels(content_id) if match.group(2) == 'label' else space.attachments(content_id)
+            start = int(params.get('start', ['0'])[0])
+            limit = space.page_limit(params)
+            chunk = items[start:start + limit]
+            return self.send_json({'results': chunk, 'start': start, 'limit': limit, 'size': len(chunk)})
+
+        match = re.match(r'^/download/attachments/(\d+)/file-(\d+)\.bin$', unquote(url.path))
+        if match:
+            data = space.attachment_data(int(match.group(1)), int(match.group(2)))
+            start = 0
+            range_header = self.headers.get('Range', '')
+            if range_header.startswith('bytes='):
+                start = int(range_header[6:].split('-')[0] or 0)
+            self.send_response(206 if start else 200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(len(data) - start))
+            self.end_headers()
+            self.wfile.write(data[start:])
+            return
+
+        self.send_json({'message': f'{url.path} is not implemented'}, status=404)
+
+
+def serve(space, host='127.0.0.1', port=8090, latency=0.0):
+    handler = type('SpaceHandler', (Handler, ), {'space': space, 'latency': latency})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--space', default='BENCH')
+    parser.add_argument('--pages', type=int, default=1000)
+    parser.add_argument('--depth', type=int, default=4)
+    parser.add_argument('--blogs', type=int, default=100)
+    parser.add_argument('--attachments', type=int, default=1)
+    parser.add_argument('--attachment-size', type=int, default=10240)
+    parser.add_argument('--labels', type=int, default=2)
+    parser.add_argument('--max-limit', type=int, default=None)
+    parser.add_argument('--latency', type=float, default=0.0)
+    args = parser.parse_args()
+
+    space = FakeSpace(
+        key=args.space,
+        pages=args.pages,
+        depth=args.depth,
+        blogs=args.blogs,
+        attachments=args.attachments,
+        attachment_size=args.attachment_size,
+        labels=args.labels,
+        max_limit=args.max_limit
+    )
+    server = serve(space, args.host, args.port, args.latency)
+    print(f'Serving {args.pages} pages and {args.blogs} blog posts in space {args.space} '
+          f'on http://{args.host}:{args.port}/', flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
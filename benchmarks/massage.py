@@ -0,0 +1,118 @@
+'''
+Compare the BeautifulSoup based Massage pipeline against the single pass Transform engine.
+
+    python benchmarks/massage.py --pages 200 --sections 50
+
+Both engines are run over the same synthetic pages, their timings are printed and their
+output is checked for equivalence. The two are not byte for byte identical, so both are
+normalised first: BeautifulSoup writes void elements XHTML style, sorts attributes, and
+re-parsing through it drops a newline here and there between elements (e.g. after a </pre>).
+None of that changes how a page renders, so the comparison sorts attributes and collapses
+whitespace-only text between elements (outside <pre>) to a single newline.
+'''
+import sys
+import time
+import difflib
+import argparse
+from pathlib import Path
+import lxml.html
+
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent))
+from confluence2pelican.massage import Massage  # noqa: E402
+from confluence2pelican.transform import Transform  # noqa: E402
+
+
+SECTION = '''
+<h2>Section {n}</h2>
+<style>.section-{n} {{ color: red; }}</style>
+<p>Some text with a <a href="https://conf.example.com/pages/viewpage.action?pageId={page_id}">link to a page</a>
+and an attachment
+<a data-linked-resource-container-id="{page_id}" data-linked-resource-id="{n}" data-linked-resource-type="attachment"
+   data-nice-type="Zip Archive" href="https://conf.example.com/download/attachments/{page_id}/file-{n}.zip?version=1&amp;api=v2">file-{n}.zip</a>.</p>
+<span class="confluence-embedded-file-wrapper confluence-embedded-manual-size">
+<img class="confluence-embedded-image" height="77" src="https://conf.example.com/download/attachments/{page_id}/image-{n}.png?api=v2"/>
+</span>
+<pre class="syntaxhighlighter-pre" data-syntaxhighlighter-params="brush: py; gutter: false">print({n})</pre>
+'''
+
+
+def synthetic_page(page_id, sections):
+    return {
+        'id': str(page_id),
+        'title': f'Page {page_id}',
+        'history': {'createdDate': '2018-08-17T09:19:31.000+10:00', 'createdBy': {'username': 'admin'}},
+        'version': {'when': '2018-08-17T09:19:31.000+10:00'},
+        'body': {'export_view': {'value': ''.join(SECTION.format(n=n, page_id=page_id) for n in range(sections))}},
+    }
+
+
+def synthetic_export_files(page_id, sections):
+    export_files = {str(page_id): 'pages/page.html'}
+    for n in range(sections):
+        export_files[f'att{n}'] = Path('pages/page', f'file-{n}.zip')
+        export_files[f'{page_id}/image-{n}.png'] = Path('pages/page', f'image-{n}.png')
+    return export_files
+
+
+def run_massage(page, export_files):
+    m = Massage(page, ['menu'], destination='pages/page.html', export_files=export_files)
+    m.remove_styles()
+    m.convert_page_links(convert_to_index_html=True)
+    m.convert_attachment_links()
+    m.convert_code_to_prettyprint()
+    m.replace_embedded_images()
+    return m.generate_html()
+
+
+def run_transform(page, export_files):
+    t = Transform(
+        page, ['menu'], destination='pages/page.html', export_files=export_files, convert_to_index_html=True
+    )
+    return t.apply().generate_html()
+
+
+def normalise(html):
+    document = lxml.html.document_fromstring(html)
+    for element in document.iter():
+        attributes = sorted(element.attrib.items())
+        element.attrib.clear()
+        element.attrib.update(attributes)
+        in_pre = element.tag == 'pre' or any(parent.tag == 'pre' for parent in element.iterancestors())
+        if element.text is not None and not element.text.strip() and not in_pre:
+            element.text = '\n'
+        if element.tail is not None and not element.tail.strip() and not (in_pre and element.tag != 'pre'):
+            element.tail = '\n'
+    return lxml.html.tostring(document, encoding='unicode')
+
+
+def timed(func, pages, export_files):
+    start = time.perf_counter()
+    outputs = [func(page, export_files) for page in pages]
+    return time.perf_counter() - start, outputs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pages', type=int, default=200)
+    parser.add_argument('--sections', type=int, default=50)
+    args = parser.parse_args()
+
+    pages = [synthetic_page(1000, args.sections) for _ in range(args.pages)]
+    export_files = synthetic_export_files(1000, args.sections)
+
+    massage_time, massage_out = timed(run_massage, pages, export_files)
+    transform_time, transform_out = timed(run_transform, pages, export_files)
+    identical = all(normalise(a) == normalise(b) for a, b in zip(massage_out, transform_out))
+
+    print(f'pages: {args.pages}, sections per page: {args.sections}')
+    print(f'massage (BeautifulSoup): {massage_time:.3f}s ({args.pages / massage_time:.1f} pages/s)')
+    print(f'transform (lxml):        {transform_time:.3f}s ({args.pages / transform_time:.1f} pages/s)')
+    print(f'speedup: {massage_time / transform_time:.2f}x, equivalent output: {identical}')
+    if not identical:
+        for a, b in zip(massage_out, transform_out):
+            if normalise(a) != normalise(b):
+                print('\n'.join(difflib.unified_diff(
+                    normalise(a).splitlines(), normalise(b).splitlines(), 'massage', 'transform', lineterm=''
+                )))
+                break
+    sys.exit(0 if identical else 1)
@@ -0,0 +1,164 @@
+'''
+End to end benchmark of slurp, export and pelican against benchmarks/fake_confluence.py.
+
+    python benchmarks/run.py --sizes 1000 10000 50000 --latency 0.02 --output bench.json
+
+For each size a fake space is served from a separate process and a fresh data directory is
+slurped (from scratch, then again incrementally with nothing changed), exported and, if pelican
+is installed, built with the repository's pelicanconf.py and theme. Before that a small space
+is slurped into one Store repeatedly, as watch mode does, to check deletions are still noticed.
+'''
+import os
+import sys
+import json
+import time
+import socket
+import shutil
+import logging
+import argparse
+import tempfile
+import threading
+import subprocess
+from pathlib import Path
+
+repo_dir = Path(__file__).absolute().parent.parent
+sys.path.insert(0, str(repo_dir))
+from confluence2pelican.slurp import Slurp  # noqa: E402
+from confluence2pelican.store import Store  # noqa: E402
+from confluence2pelican.export import Export  # noqa: E402
+from fake_confluence import FakeSpace, serve  # noqa: E402
+
+
+def wait_for_port(host, port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection((host, port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'fake confluence did not start on {host}:{port}')
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    func(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def check_index(store):
+    '''
+    Store.load_index() reads raw rows into records, make sure they agree with what pydal returns
+    '''
+    rows = {row.id: row for row in store.load_index(with_json=True).contents}
+    for record in store.load_index().contents:
+        row = rows[record.id]
+        for name in record.__slots__:
+            expected = row[name]
+            if name == 'labels':
+                expected = expected or []
+            if getattr(record, name) != expected:
+                raise AssertionError(f'{record!r}.{name} is {getattr(record, name)!r}, pydal has {expected!r}')
+
+
+def check_deletions(args):
+    '''
+    Slurp a small space into one Store three times (as watch mode does), deleting two blog posts
+    before each incremental slurp, and make sure they are gone from the Store afterwards. The
+    server caps page sizes below what Slurp asks for, so nothing must be lost to paging either.
+    '''
+    space = FakeSpace(
+        pages=20, blogs=10, attachments=args.attachments, attachment_size=args.attachment_size, max_limit=7
+    )
+    server = serve(space, port=args.port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    data_dir = Path(tempfile.mkdtemp(prefix='c2p-bench-deletions-'))
+    try:
+        slurp = Slurp(url=f'http://127.0.0.1:{args.port}/', username='bench', password='bench', space_key=space.key)
+        store = Store(data_dir)
+        for incremental in (False, True, True):
+            slurp.slurp(store=store, incremental=incremental)
+            held = store.db(store.db.content).count()
+            if held != space.page_count + space.blog_count:
+                raise AssertionError(f'Store holds {held} items, the space has {space.page_count + space.blog_count}')
+            space.blog_count -= 2
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def run_pelican(data_dir):
+    if not shutil.which('pelican'):
+        return None
+    for name in ('pelicanconf.py', 'theme', 'pelican_plugins'):
+        os.symlink(Path(repo_dir, 'data', name), Path(data_dir, name))
+    start = time.perf_counter()
+    subprocess.run(['pelican', '-q', '-s', str(Path(data_dir, 'pelicanconf.py'))], check=True)
+    return time.perf_counter() - start
+
+
+def bench(size, args):
+    server = subprocess.Popen([
+        sys.executable, str(Path(repo_dir, 'benchmarks', 'fake_confluence.py')),
+        '--port', str(args.port),
+        '--pages', str(size),
+        '--depth', str(args.depth),
+        '--blogs', str(max(1, size // 10)),
+        '--attachments', str(args.attachments),
+        '--attachment-size', str(args.attachment_size),
+        '--latency', str(args.latency),
+    ], stdout=subprocess.DEVNULL)
+    data_dir = Path(tempfile.mkdtemp(prefix=f'c2p-bench-{size}-'))
+    try:
+        wait_for_port('127.0.0.1', args.port)
+        slurp = Slurp(
+            url=f'http://127.0.0.1:{args.port}/',
+            username='bench',
+            password='bench',
+            space_key='BENCH',
+            concurrency=args.concurrency
+        )
+        store = Store(data_dir)
+        result = {'pages': size}
+        result['slurp'] = timed(slurp.slurp, store=store)
+        result['slurp_incremental'] = timed(slurp.slurp, store=store, incremental=True)
+        check_index(store)
+        export = Export(data_dir, jobs=args.jobs)
+        result['export'] = timed(export.export, store=store)
+        result['export_unchanged'] = timed(export.export, store=store)
+        result['pelican'] = run_pelican(data_dir) if args.pelican else None
+        return result
+    finally:
+        server.terminate()
+        server.wait()
+        if not args.keep:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 50000])
+    parser.add_argument('--depth', type=int, default=4)
+    parser.add_argument('--attachments', type=int, default=1)
+    parser.add_argument('--attachment-size', type=int, default=10240)
+    parser.add_argument('--latency', type=float, default=0.02)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('-j', '--jobs', type=int, default=1)
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--no-pelican', dest='pelican', action='store_false', default=True)
+    parser.add_argument('--keep', action='store_true', default=False)
+    parser.add_argument('--output', metavar='FILE', default=None)
+    args = parser.parse_args()
+    logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.WARNING)
+
+    check_deletions(args)
+    results = []
+    for size in args.sizes:
+        result = bench(size, args)
+        results.append(result)
+        print(' '.join(f'{k}={v:.2f}s' if isinstance(v, float) else f'{k}={v}' for k, v in result.items()), flush=True)
+
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump({'settings': vars(args), 'results': results}, fh, indent=2)
@@ -3,10 +3,18 @@ import sys
 import json
 import logging
 import argparse
+import cProfile
+import pstats
+from pathlib import Path
 from .massage import Massage
 from .slurp import Slurp
-from .store import Store
+from .crawl import Crawler
+from .transport import Transport
 from .export import Export
+from .images import ImageStage
+from .manifest import Manifest
+from .spaces import SpacePipeline, space_data_dir, run_pipelines
+from .metrics import metrics
 
 
 logger = logging.getLogger(f'{__package__}.{__name__}')
@@ -22,10 +30,22 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--data-dir', metavar='DATA_DIR', default='./data')
     parser.add_argument('-d', '--debug', action='store_true', default=False)
+    parser.add_argument('--space', metavar='KEY', action='append', default=None)
     parser.add_argument('-c', '--create', action='store_true', default=False)
     parser.add_argument('-s', '-1', '--slurp', action='store_true', default=False)
+    parser.add_argument('-i', '--incremental', action='store_true', default=False)
+    parser.add_argument('--concurrency', metavar='N', type=int, default=None)
+    parser.add_argument('--since', metavar='DATE', default=None)
     parser.add_argument('-e', '-2', '--export', action='store_true', default=False)
+    parser.add_argument('-j', '--jobs', metavar='N', type=int, default=1)
+    parser.add_argument('--target', choices=['files', 'store'], default='files')
     parser.add_argument('-p', '-3', '--pelican', action='store_true', default=False)
+    parser.add_argument('-m', '-4', '--manifest', action='store_true', default=False)
+    parser.add_argument('-w', '--watch', action='store_true', default=False)
+    parser.add_argument('--interval', metavar='SECONDS', type=int, default=None)
+    parser.add_argument('--debounce', metavar='SECONDS', type=int, default=None)
+    parser.add_argument('--on-change', metavar='COMMAND', default=None)
+    parser.add_argument('--profile', action='store_true', default=False)
     args = parser.parse_args()
 
     logging.basicConfig(
@@ -51,18 +71,112 @@ if __name__ == '__main__':
         with open(config_file, 'r') as fh:
             config = json.loads(fh.read())
 
-    # Setup the Slurp object (used to retrieve pages from Confluence)
-    store = Store(args.data_dir)
-    export = Export(args.data_dir, config.get('pelican_settings', {}))
-    slurp = Slurp(
-        url=config['confluence_url'],
-        username=config['confluence_username'],
-        password=config['confluence_password'],
-        space_key=config['confluence_space']
+    # One or more spaces, each slurped and exported into a data directory of its own
+    spaces = args.space or config['confluence_space']
+    spaces = [spaces] if isinstance(spaces, str) else list(spaces)
+    partitioned = len(spaces) > 1
+
+    # Every space shares one connection pool, crawler and request budget (used to retrieve pages from Confluence)
+    concurrency = args.concurrency or config.get('confluence_concurrency', 8)
+    download_workers = config.get('download_workers', 4)
+    crawler = Crawler(concurrency)
+    transport = Transport(
+        config['confluence_url'], (config['confluence_username'], config['confluence_password']),
+        pool_size=concurrency + download_workers * len(spaces),
+        retries=config.get('confluence_retries', 5),
+        rate=config.get('confluence_rate_limit', None),
+        max_in_flight=config.get('confluence_max_in_flight', concurrency + download_workers)
     )
+    pipelines = []
+    for space_key in spaces:
+        data_dir = space_data_dir(args.data_dir, space_key, partitioned)
+        space_metrics = metrics.scoped(f'{space_key}.' if partitioned else '')
+        export = Export(
+            data_dir, config.get('pelican_settings', {}),
+            jobs=args.jobs,
+            target=args.target,
+            images=ImageStage(
+                data_dir,
+                widths=config.get('image_widths', (320, 640, 1280)),
+                image_format=config.get('image_format', 'webp'),
+                quality=config.get('image_quality', 80),
+                workers=config.get('image_workers', 4)
+            ),
+            metrics=space_metrics
+        )
+        slurp = Slurp(
+            url=config['confluence_url'],
+            username=config['confluence_username'],
+            password=config['confluence_password'],
+            space_key=space_key,
+            download_workers=download_workers,
+            blog_page_size=config.get('blog_page_size', 50),
+            blog_prefetch=config.get('blog_prefetch', 2),
+            transport=transport,
+            crawler=crawler,
+            metrics=space_metrics
+        )
+        pipelines.append(SpacePipeline(space_key, data_dir, slurp, export, metrics=space_metrics))
+
+    profile = cProfile.Profile() if args.profile else None
+    if profile:
+        profile.enable()
+
+    if args.slurp or args.export:
+        run_pipelines(
+            pipelines, 'run',
+            slurp=args.slurp, incremental=args.incremental, since=args.since, export=args.export
+        )
+
+    # Stay running, slurping and exporting whatever changes in Confluence from here on
+    if args.watch:
+        run_pipelines(
+            pipelines, 'watch',
+            interval=args.interval or config.get('watch_interval', 10),
+            debounce=args.debounce or config.get('watch_debounce', 5),
+            full_every=config.get('watch_full_every', 3600),
+            command=args.on_change or config.get('watch_command', None)
+        )
 
-    if args.slurp:
-        slurp.slurp(store=store)
+    # Compare Pelican's output with what was last published, publish.sh only uploads the difference
+    if args.manifest:
+        with metrics.stage('manifest'):
+            for pipeline in pipelines:
+                manifest_file = Path(pipeline.data_dir, 'output_manifest.json')
+                manifest = Manifest.scan(Path(pipeline.data_dir, 'output'), previous=Manifest.load(manifest_file))
+                manifest.save(manifest_file)
+                changes = manifest.write_changes(
+                    Manifest.load(Path(pipeline.data_dir, 'published_manifest.json')),
+                    Path(pipeline.data_dir, 'publish')
+                )
+                for name, paths in changes.items():
+                    pipeline.metrics.count(f'manifest.{name}', len(paths))
 
-    if args.export:
-        export.export(store=store)
\ No newline at end of file
+    # Written next to per_export_settings.json so each run can be compared with the last. With several
+    # spaces each gets a report of its own too, the top level one has them all with space key prefixes
+    report = {'spaces': spaces, 'requests': transport.report()}
+    if profile:
+        profile.disable()
+        profile_file = os.path.join(args.data_dir, 'profile.pstats')
+        profile.dump_stats(profile_file)
+        stats = pstats.Stats(profile)
+        report['profile'] = {
+            'file': profile_file,
+            'top': [
+                {
+                    'function': f'{filename}:{line}({name})',
+                    'calls': calls,
+                    'total_seconds': total,
+                    'cumulative_seconds': cumulative
+                }
+                for (filename, line, name), (_, calls, total, cumulative, _) in sorted(
+                    stats.stats.items(), key=lambda item: item[1][3], reverse=True
+                )[0:30]
+            ]
+        }
+    # publish.sh runs with just --manifest, which shouldn't replace the report of the last slurp/export
+    if args.slurp or args.export or profile:
+        metrics.write(os.path.join(args.data_dir, 'metrics.json'), **report)
+        if partitioned:
+            for pipeline in pipelines:
+                pipeline.metrics.write(Path(pipeline.data_dir, 'metrics.json'), spaces=[pipeline.space_key])
\ No newline at end of file
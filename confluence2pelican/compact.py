@@ -0,0 +1,82 @@
+import zlib
+import base64
+from json import dumps, loads
+from functools import cached_property
+from collections.abc import Mapping
+
+
+def project(content_json):
+    '''
+    The small part of Confluence's expanded content that exporting actually reads (less the body)
+    '''
+    return {
+        'id': content_json['id'],
+        'type': content_json['type'],
+        'title': content_json['title'],
+        'version': {
+            'number': content_json['version']['number'],
+            'when': content_json['version']['when']
+        },
+        'history': {
+            'createdDate': content_json['history']['createdDate'],
+            'createdBy': {'username': content_json['history']['createdBy'].get('username')}
+        }
+    }
+
+
+def compress_body(html):
+    if html is None:
+        return None
+    return base64.b64encode(zlib.compress(html.encode('utf-8'))).decode('ascii')
+
+
+def decompress_body(value):
+    if value is None:
+        return None
+    return zlib.decompress(base64.b64decode(value)).decode('utf-8')
+
+
+def compact(content_json):
+    '''
+    (meta, body) columns for the Store from expanded content
+    '''
+    return dumps(project(content_json)), compress_body(content_json['body']['export_view']['value'])
+
+
+class CompactContent(Mapping):
+    '''
+    Read-only stand-in for the expanded content json, built from the meta and body columns.
+    Neither is decoded until something reads from it.
+    '''
+    def __init__(self, meta, body):
+        self.raw_meta = meta
+        self.raw_body = body
+
+    @cached_property
+    def meta(self):
+        return loads(self.raw_meta)
+
+    @cached_property
+    def body(self):
+        return {'export_view': {'value': decompress_body(self.raw_body)}}
+
+    def __getitem__(self, key):
+        if key == 'body':
+            return self.body
+        return self.meta[key]
+
+    def __iter__(self):
+        yield from self.meta
+        yield 'body'
+
+    def __len__(self):
+        return len(self.meta) + 1
+
+
+def stored_content(meta, body, json=None):
+    '''
+    Content as stored by Store, falling back to the full json kept by older versions
+    '''
+    if meta is None:
+        return loads(json)
+    return CompactContent(meta, body)
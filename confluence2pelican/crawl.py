@@ -0,0 +1,39 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+
+logger = logging.getLogger(f'{__package__}.{__name__}')
+
+
+class Crawler:
+    def __init__(self, concurrency=8):
+        self.concurrency = max(1, int(concurrency))
+        self.pool = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='crawl')
+
+    def map(self, func, items):
+        '''
+        Run func over items using at most `concurrency` threads, results are returned in order
+        '''
+        return self.pool.map(func, items)
+
+    def walk(self, root_id, fetch, children):
+        '''
+        Breadth-first walk of a tree starting at root_id, fetching each tier concurrently.
+        fetch(node_id) returns the node (or None to prune it) and children(node) returns child ids.
+        Yields (node_id, parent_id, level, node) with every parent yielded before its children.
+        '''
+        tier = [(root_id, None)]
+        level = 0
+        while tier:
+            logger.debug('Crawling %d nodes at level %d', len(tier), level)
+            next_tier = []
+            for (node_id, parent_id), node in zip(tier, self.map(fetch, [node_id for node_id, _ in tier])):
+                if node is None:
+                    continue
+                yield node_id, parent_id, level, node
+                next_tier.extend((child_id, node_id) for child_id in children(node))
+            tier = next_tier
+            level += 1
+
+    def close(self):
+        self.pool.shutdown(wait=True)
@@ -6,12 +6,17 @@ from pydal import DAL, Field
 logger = logging.getLogger(f'{__package__}.{__name__}')
 
 
-def setup_database(data_dir, sub_dir, db_file, tables):
+def setup_database(data_dir, sub_dir, db_file, tables, indexes=None):
     # Figure out where our database should live
     db_folder = Path(data_dir, sub_dir).absolute()
     db_folder.mkdir(exist_ok=True, parents=True)
     db = DAL(f'sqlite://{db_folder}/store.sqlite', folder=db_folder)
 
+    # We are the only writer and can always slurp again, so trade durability for ingest speed
+    db.executesql('PRAGMA journal_mode=WAL')
+    db.executesql('PRAGMA synchronous=NORMAL')
+    db.executesql('PRAGMA temp_store=MEMORY')
+
     for table_name in tables:
         db.define_table(
             table_name,
@@ -19,4 +24,9 @@ def setup_database(data_dir, sub_dir, db_file, tables):
             migrate=f'{table_name}.migrate'
         )
 
+    for table_name in (indexes or {}):
+        for field in indexes[table_name]:
+            db.executesql(f'CREATE INDEX IF NOT EXISTS {table_name}_{field}_idx ON {table_name} ({field})')
+    db.commit()
+
     return db
\ No newline at end of file
@@ -0,0 +1,93 @@
+import os
+import hashlib
+import logging
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from .metrics import metrics as default_metrics
+
+
+logger = logging.getLogger(f'{__package__}.{__name__}')
+
+
+class Downloader:
+    min_chunk_size = 64 * 1024
+    max_chunk_size = 4 * 1024 * 1024
+
+    def __init__(self, get, workers=4, metrics=None):
+        self.get = get
+        self.metrics = metrics or default_metrics
+        self.pool = ThreadPoolExecutor(max_workers=max(1, int(workers)), thread_name_prefix='download')
+        self.futures = []
+
+    def chunk_size(self, size):
+        return min(self.max_chunk_size, max(self.min_chunk_size, size // 16))
+
+    def submit(self, key, url, path, size):
+        future = self.pool.submit(self.download, url, Path(path), size)
+        self.futures.append((key, future))
+        return future
+
+    def download(self, url, path, size):
+        '''
+        Download url to path via path.part, resuming a previous partial download with a Range
+        request where possible. The file only appears at path once it is complete.
+        Returns the sha256 hex digest of the file, or None if the download failed.
+        '''
+        part_path = path.with_name(f'{path.name}.part')
+        path.parent.mkdir(parents=True, exist_ok=True)
+        offset = part_path.stat().st_size if part_path.exists() else 0
+        if offset > size:
+            logger.debug('discarding %s because it is larger than expected', part_path)
+            offset = 0
+
+        digest = hashlib.sha256()
+        if offset:
+            with open(part_path, 'rb') as fh:
+                for chunk in iter(lambda: fh.read(self.max_chunk_size), b''):
+                    digest.update(chunk)
+
+        if offset < size or not part_path.exists():
+            headers = {'Range': f'bytes={offset}-'} if offset else {}
+            res = self.get(url, stream=True, headers=headers)
+            if res.status_code == 206:
+                logger.debug('resuming %s from byte %d', path, offset)
+                mode = 'ab'
+            elif res.status_code == 200:
+                mode = 'wb'
+                digest = hashlib.sha256()
+            else:
+                logger.error('failed to download %s (HTTP %s)', url, res.status_code)
+                return None
+            with open(part_path, mode) as fh:
+                for chunk in res.iter_content(chunk_size=self.chunk_size(size)):
+                    fh.write(chunk)
+                    digest.update(chunk)
+                    self.metrics.count('download.bytes', len(chunk))
+
+        if part_path.stat().st_size != size:
+            logger.error('downloaded %s but it is the wrong size, will resume next time', path)
+            return None
+        os.replace(part_path, path)
+        self.metrics.count('download.files')
+        logger.debug('downloaded %s', url)
+        return digest.hexdigest()
+
+    def wait(self):
+        '''
+        Block until everything submitted so far has finished, returning (key, sha256) pairs
+        for the downloads that succeeded
+        '''
+        results = []
+        for key, future in self.futures:
+            try:
+                digest = future.result()
+            except Exception:
+                logger.exception('attachment download failed')
+                continue
+            if digest:
+                results.append((key, digest))
+        self.futures = []
+        return results
+
+    def close(self):
+        self.pool.shutdown(wait=True)
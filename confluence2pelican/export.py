@@ -1,20 +1,55 @@
 import os
+import time
 import logging
-import uuid
-import shutil
+import hashlib
 import itertools
+from collections import deque
 from pathlib import Path
 from json import dumps, loads
 from slugify import slugify
-from .massage import Massage
-import itertools
+from .massage import link_keys
+from .transform import Transform
+from .compact import stored_content
+from .images import ImageStage, is_image
+from .processes import process_pool
+from .metrics import metrics as default_metrics
 
 logger = logging.getLogger(f'{__package__}.{__name__}')
+FINGERPRINT_VERSION = 3  # Bump this whenever Massage output changes so every page is rewritten
+worker_settings = {}  # Set once per worker process by init_worker()
+
+
+def massage_page(content_json, labels, dest, export_files, convert_to_index_html, body_only=False, derivatives=None):
+    t = Transform(
+        content_json,
+        labels,
+        export_files=export_files,
+        destination=dest,
+        convert_to_index_html=convert_to_index_html,
+        derivatives=derivatives
+    )
+    t.apply()
+    return t.generate_body() if body_only else t.generate_html()
+
+
+def init_worker(settings):
+    worker_settings.update(settings)
+
+
+def timed_massage_page(stored, labels, dest, **settings):
+    start = time.perf_counter()
+    html = massage_page(stored_content(*stored), labels, dest, **settings)
+    return dest, html, time.perf_counter() - start
+
+
+def massage_batch(batch):
+    return [timed_massage_page(stored, labels, dest, **worker_settings) for dest, stored, labels in batch]
 
 
 class Export:
-    def __init__(self, data_dir, pelican_settings={}):
+    def __init__(self, data_dir, pelican_settings={}, jobs=1, target='files', images=None, metrics=None):
         self.data_dir = Path(data_dir).absolute()
+        self.metrics = metrics or default_metrics
         self.export_dir = Path(self.data_dir, 'exports')
         self.export_dir.mkdir(parents=True, exist_ok=True)
         self.content_paths = {}
@@ -23,42 +58,249 @@ class Export:
         self.remove_pages_from_url = True
         self.hierarchy_menus = {}
         self.hierarchy_menu_map = {}
+        self.index = None
+        self.fingerprints_file = Path(self.data_dir, 'export_fingerprints.json')
+        self.fingerprints = {}
+        self.jobs = max(1, jobs)
+        self.batch_size = 20
+        self.target = target  # 'files' writes HTML into export_dir, 'store' saves it for confluence_reader
+        self.page_ids = {}
+        self.links = {}  # Content row id to link keys, from the Store's link table
+        self.links_store = None  # The Store self.links was read from
+        self.images = images or ImageStage(self.data_dir, workers=self.jobs)
+        self.derivatives = {}  # Export path of an image to [(width, height, export path of a derivative)]
     
     def recurse_titles(self, record):
-        titles = [record.title, ]
-        while record.parent:
-            titles.append(record.parent.title)
-            record = record.parent
+        titles = [record.title, ] + [parent.title for parent in self.index.ancestors(record)]
         return ' -> '.join(reversed(titles))
 
-    def build_menu(self, all_content, level=None, parent=None, grandparent=None):
-        menu_tier = []
+    def page_url(self, content_id):
+        url = self.export_files[content_id]
+        if self.convert_to_index_html and url.endswith('.html'):
+            url = f'/{url[0:-5]}/'
+        if self.remove_pages_from_url and url.startswith('/pages/'):
+            url = url[6:]
+        return url
+
+    def build_menu(self, all_content):
+        '''
+        Build MENU_HIERARCHY (filling in hierarchy_menus and hierarchy_menu_map on the way) by
+        grouping pages under their parent once and then visiting each page once.
+        '''
+        children = {}
         for content in all_content:
-            if parent is None and level is None:
-                grandparent = content.id_
-            if (parent is None and content.level == 1) or (parent and content.parent.id_ == parent):
-                url = self.export_files[content.id_]
-                if self.convert_to_index_html and url.endswith('.html'):
-                    url = f'/{url[0:-5]}/'
-                if self.remove_pages_from_url and url.startswith('/pages/'):
-                    url = url[6:]
-                
-                sub_menu = self.build_menu(all_content, parent=content.id_, grandparent=grandparent)
-                if 'hidden' not in content.labels and ('menu' in content.labels or content.level > 1):
+            children.setdefault(self.index.parent_id(content), []).append(content)
+
+        def build_tier(parent_id, grandparent):
+            menu_tier = []
+            for content in children.get(parent_id, []):
+                url = self.page_url(content.id_)
+                sub_menu = build_tier(content.id_, grandparent)
+                if 'hidden' not in content.labels:
                     menu_tier.append([content.title, url, sub_menu])
                 self.hierarchy_menu_map[url] = grandparent
-                if content.level == 1:
-                    self.hierarchy_menus[grandparent] = [[content.title, url, sub_menu], ]
-        return menu_tier
+            return menu_tier
+
+        menu = []
+        for content in all_content:
+            if content.level != 1:
+                continue
+            url = self.page_url(content.id_)
+            sub_menu = build_tier(content.id_, content.id_)
+            if 'hidden' not in content.labels and 'menu' in content.labels:
+                menu.append([content.title, url, sub_menu])
+            self.hierarchy_menu_map[url] = content.id_
+            self.hierarchy_menus[content.id_] = [[content.title, url, sub_menu], ]
+        return menu
+
+    def fingerprint(self, record, keys, dest):
+        '''
+        Hash of everything that goes into a page's output: its version, labels, where it lives
+        and where each of the links in it (keys, see link_keys()) currently resolve to.
+        '''
+        parts = [
+            FINGERPRINT_VERSION,
+            str(dest),
+            record.version,
+            sorted(record.labels or []),
+            self.convert_to_index_html,
+            [(key, str(self.export_files.get(key))) for key in keys],
+            [self.derivatives.get(str(self.export_files.get(key))) for key in keys],
+        ]
+        return hashlib.sha1(dumps(parts).encode('utf-8')).hexdigest()
+
+    def is_unchanged(self, dest, record, fingerprint, previous_fingerprints):
+        if self.target == 'store':
+            return record.html_fingerprint == fingerprint
+        return Path(self.export_dir, dest).exists() and previous_fingerprints.get(str(dest)) == fingerprint
+
+    def load_fingerprints(self):
+        if self.fingerprints_file.exists():
+            with self.fingerprints_file.open('rb') as fh:
+                return loads(fh.read())
+        return {}
+
+    def remove_orphans(self, expected):
+        for path in sorted(self.export_dir.rglob('*'), reverse=True):
+            if path.is_dir():
+                if not any(path.iterdir()):
+                    path.rmdir()
+            elif str(path.relative_to(self.export_dir)) not in expected:
+                logger.debug('Removing orphan %s', path)
+                path.unlink()
+
+    def link_file(self, real_path, dest):
+        '''
+        Hard link real_path into export_dir as dest, unless it is already there
+        '''
+        link_path = Path(self.export_dir, dest)
+        link_path.parent.mkdir(parents=True, exist_ok=True)
+        if link_path.exists():
+            if os.path.samefile(real_path, link_path):
+                return
+            link_path.unlink()
+        os.link(real_path, link_path)
+
+    def write_if_changed(self, path, data):
+        if path.exists() and path.read_bytes() == data:
+            return False
+        path.write_bytes(data)
+        return True
+
+    def massage_pages(self, pending):
+        '''
+        Massage an iterable of (dest, (meta, body, json), labels) tuples, yielding (dest, html) for each.
+        With more than one job the link map is sent to each worker process once, and pages in batches.
+        Only a couple of batches per worker are in flight at once, so pending can be a stream.
+        '''
+        if self.jobs == 1:
+            for dest, stored, labels in pending:
+                dest, html, seconds = timed_massage_page(stored, labels, dest, **self.transform_settings())
+                self.metrics.observe('export.transform', seconds, dest)
+                yield dest, html
+            return
+
+        pending = iter(pending)
+        in_flight = deque()
+        with process_pool(
+            self.jobs,
+            initializer=init_worker,
+            initargs=(self.transform_settings(), )
+        ) as pool:
+            while True:
+                batch = list(itertools.islice(pending, self.batch_size))
+                if batch:
+                    in_flight.append(pool.submit(massage_batch, batch))
+                if in_flight and (not batch or len(in_flight) >= self.jobs * 2):
+                    for dest, html, seconds in in_flight.popleft().result():
+                        self.metrics.observe('export.transform', seconds, dest)
+                        yield dest, html
+                elif not batch:
+                    break
+
+    def transform_settings(self):
+        return {
+            'export_files': self.export_files,
+            'convert_to_index_html': self.convert_to_index_html,
+            'body_only': self.target == 'store',
+            'derivatives': self.derivatives
+        }
+
+    def load_links(self, store):
+        '''
+        Bring self.links up to date, re-reading only the rows the Store says have changed when
+        this Export has read from the same Store before (as it does in watch mode)
+        '''
+        changed = store.take_changed_links() if self.links_store is store else None
+        if changed is None:
+            self.links = store.link_map()
+            store.take_changed_links()
+            self.links_store = store
+            return
+        fresh = store.link_map(sources=changed)
+        for source in changed:
+            self.links[source] = fresh.get(source, [])
+
+    def page_links(self, store, record, stored=None):
+        '''
+        The link keys of record from the Store's link table, or extracted from its stored content
+        (and saved for next time) if the table doesn't have them for this version yet
+        '''
+        if record.links_version == record.version:
+            return self.links.get(record.id, [])
+        if stored is None:
+            return None
+        keys = link_keys(stored_content(*stored))
+        store.store_links(record.id, keys, record.version)
+        self.links[record.id] = keys
+        return keys
+
+    def broken_links(self, store):
+        '''
+        Map of each page's export path to the links in it that don't resolve to anything we export
+        '''
+        targets = set(key for keys in self.links.values() for key in keys)
+        broken = {}
+        for key, sources in store.linked_from(targets - set(self.export_files)).items():
+            for source in sources:
+                record = self.index.by_row_id.get(source)
+                if record is None or record.id_ not in self.export_files:
+                    continue
+                # Images are looked up as "<content id>/<file name>" and then by file name alone,
+                # so only the first is reported
+                if f'{record.id_}/{key}' in self.export_files or f'{record.id_}/{key}' in self.links.get(source, []):
+                    continue
+                if key.startswith(f'{record.id_}/') and key.split('/', 1)[1] in self.export_files:
+                    continue
+                broken.setdefault(self.export_files[record.id_], []).append(key)
+        return {dest: sorted(keys) for dest, keys in sorted(broken.items())}
+
+    def changed_pages(self, store, pages, previous_fingerprints):
+        '''
+        Second pass of export(), yielding (dest, (meta, body, json), labels) for pages whose fingerprint
+        has changed. Fingerprints come from the Store's link table, so only the bodies of pages that
+        have to be rendered again (or whose links were never extracted) are streamed from the Store.
+        '''
+        to_read = set()
+        for content_id, (dest, record) in pages.items():
+            keys = self.page_links(store, record)
+            if keys is None:
+                to_read.add(content_id)
+                continue
+            fingerprint = self.fingerprint(record, keys, dest)
+            self.fingerprints[str(dest)] = fingerprint
+            if not self.is_unchanged(dest, record, fingerprint, previous_fingerprints):
+                to_read.add(content_id)
+
+        ids = to_read if len(to_read) < len(pages) / 2 else None
+        for content_id, meta, body, json in store.iter_content(ids=ids):
+            if content_id not in to_read:
+                continue
+            dest, record = pages[content_id]
+            stored = (meta, body, json)
+            if str(dest) not in self.fingerprints:
+                fingerprint = self.fingerprint(record, self.page_links(store, record, stored), dest)
+                self.fingerprints[str(dest)] = fingerprint
+                if self.is_unchanged(dest, record, fingerprint, previous_fingerprints):
+                    continue
+            yield (dest, stored, record.labels)
 
     def export(self, store):
-        logger.debug('Removing old exports: %s', self.export_dir)
-        shutil.rmtree(self.export_dir)
         exports = []
         pages = []
+        with self.metrics.stage('export.load_index'):
+            self.index = store.load_index()
+            self.load_links(store)
+        self.content_paths = {}
+        self.export_files = {}
+        self.hierarchy_menus = {}
+        self.hierarchy_menu_map = {}
+        previous_fingerprints = self.load_fingerprints()
+        self.fingerprints = {}
+        self.page_ids = {}
 
-        # Doing all this in memory so we can resolve links
-        for content, attachments in itertools.chain(store.iter_pages(min_level=1), store.iter_blog()):
+        # First pass works out where everything goes from metadata alone, so we can resolve links
+        for content, attachments in itertools.chain(self.index.pages(min_level=1), self.index.blog()):
             logger.debug('Processing [%s] %s', content.id, self.recurse_titles(content))
             export_dir = None
             if content.type == 'blogpost':
@@ -82,38 +324,76 @@ class Export:
                 self.export_files[f'{content.id_}/{attachment.title}'] = attach_file
             exports.append(('page', export_file, content))
 
+        pages_by_id = {}
+        images = []
         for export_type, dest, record in exports:
             if export_type == 'file':
-                real_path = Path(self.data_dir, record.path_current)
-                link_path = Path(self.export_dir, dest)
-                link_path.parent.mkdir(parents=True, exist_ok=True)
-                if link_path.exists():
-                    link_path.unlink()
-                os.link(real_path, link_path)
+                self.metrics.count('export.attachments')
+                real_path = Path(self.data_dir, record.path_current or '')
+                if not record.path_current or not real_path.exists():
+                    logger.warning('Skipping %s, it has not been downloaded', real_path)
+                    continue
+                self.link_file(real_path, dest)
+                if is_image(record.title):
+                    images.append((dest, real_path, record))
             else:
-                m = Massage(
-                    loads(record.json),
-                    record.labels,
-                    export_files=self.export_files,
-                    destination=dest,
-                )
-                m.remove_styles()
-                m.convert_page_links(convert_to_index_html=self.convert_to_index_html)
-                m.convert_attachment_links()
-                m.convert_code_to_prettyprint()
-                m.replace_embedded_images()
-
-                exp_path = Path(self.export_dir, dest)
-                exp_path.parent.mkdir(parents=True, exist_ok=True)
-                with open(exp_path, 'w') as fh:
-                    logger.debug('Writing %s', exp_path)
-                    fh.write(m.generate_html())
-
-        menu = self.build_menu(pages)
+                pages_by_id[record.id_] = (dest, record)
+                self.page_ids[str(dest)] = record.id_
+
+        with self.metrics.stage('export.images'):
+            derived = self.images.derive([(real_path, record) for _, real_path, record in images])
+            self.derivatives = {}
+            for dest, _, record in images:
+                for width, height, cache_path in derived.get(record.id_, []):
+                    derivative = Path(dest.parent, f'{dest.name}.{width}w{cache_path.suffix}')
+                    self.link_file(cache_path, derivative)
+                    self.derivatives.setdefault(str(dest), []).append((width, height, str(derivative)))
+                    exports.append(('derivative', derivative, record))
+            self.images.prune([record for _, _, record in images])
+        self.metrics.count('export.images.derivatives', sum(len(d) for d in self.derivatives.values()))
+
+        written = 0
+        with self.metrics.stage('export.pages'):
+            for dest, html in self.massage_pages(self.changed_pages(store, pages_by_id, previous_fingerprints)):
+                if self.target == 'store':
+                    store.store_html(self.page_ids[str(dest)], dest, html, self.fingerprints[str(dest)])
+                else:
+                    exp_path = Path(self.export_dir, dest)
+                    exp_path.parent.mkdir(parents=True, exist_ok=True)
+                    with open(exp_path, 'w') as fh:
+                        logger.debug('Writing %s', exp_path)
+                        fh.write(html)
+                written += 1
+        if self.target != 'store':
+            store.clear_html()
+        store.save()
+        self.metrics.count('export.pages.written', written)
+        self.metrics.count('export.pages.unchanged', len(self.fingerprints) - written)
+
+        self.remove_orphans(set(
+            str(dest) for export_type, dest, _ in exports if export_type != 'page' or self.target != 'store'
+        ))
+        logger.info('Exported %d of %d pages, the rest were unchanged', written, len(self.fingerprints))
+
+        broken = self.broken_links(store)
+        for dest, keys in broken.items():
+            logger.warning('%s has broken links to %s', dest, ', '.join(keys))
+        self.metrics.count('export.links.broken', sum(len(keys) for keys in broken.values()))
+        self.write_if_changed(
+            Path(self.data_dir, 'broken_links.json'),
+            dumps(broken, indent=2).encode('utf-8')
+        )
+        with self.fingerprints_file.open('wb') as fh:
+            fh.write(dumps(self.fingerprints, indent=2, sort_keys=True).encode('utf-8'))
+
+        with self.metrics.stage('export.menu'):
+            menu = self.build_menu(pages)
         export_settings = {
             'MENU_HIERARCHY': menu,
             'HIERARCHY_MENU_MAP': self.hierarchy_menu_map,
             'HIERARCHY_MENUS': self.hierarchy_menus
         }
-        with Path(self.data_dir, 'per_export_settings.json').open('wb') as fh:
-            fh.write(dumps(export_settings, indent=2).encode('utf-8'))
\ No newline at end of file
+        self.write_if_changed(
+            Path(self.data_dir, 'per_export_settings.json'),
+            dumps(export_settings, indent=2).encode('utf-8')
+        )
@@ -0,0 +1,110 @@
+import os
+import logging
+from pathlib import Path
+from json import dumps, loads
+from .processes import process_pool
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+
+logger = logging.getLogger(f'{__package__}.{__name__}')
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff', '.webp')  # Not .gif, it may be animated
+
+
+def is_image(title):
+    return Path(title).suffix.lower() in IMAGE_EXTENSIONS
+
+
+def build_derivatives(source, cache_dir, widths, image_format, quality):
+    '''
+    Resize source to each of widths narrower than it (plus its own width) in image_format, saving
+    them and an index.json of [width, height, file name] into cache_dir. Whatever is in the index
+    already is returned as is, so each attachment version is only ever built once.
+    '''
+    index_file = Path(cache_dir, 'index.json')
+    if index_file.exists():
+        return loads(index_file.read_bytes())
+    Path(cache_dir).mkdir(parents=True, exist_ok=True)
+    built = []
+    try:
+        with Image.open(source) as image:
+            image = ImageOps.exif_transpose(image)
+            if image.mode not in ('RGB', 'RGBA'):
+                image = image.convert('RGBA' if image.mode in ('LA', 'P', 'PA') else 'RGB')
+            for width in sorted(set(w for w in widths if w < image.width) | {image.width}):
+                height = max(1, round(image.height * width / image.width))
+                name = f'{width}.{image_format}'
+                resized = image if width == image.width else image.resize((width, height), Image.LANCZOS)
+                resized.save(Path(cache_dir, name), quality=quality)
+                built.append([width, height, name])
+    except (OSError, ValueError) as e:
+        logger.warning('Could not build derivatives of %s: %s', source, e)
+        built = []
+    index_file.with_suffix('.part').write_bytes(dumps(built).encode('utf-8'))
+    os.replace(index_file.with_suffix('.part'), index_file)
+    return built
+
+
+class ImageStage:
+    '''
+    Resized, modern format copies of image attachments for srcset, cached under data/derivatives
+    by attachment id and version and built in a pool of worker processes.
+    '''
+    def __init__(self, data_dir, widths=(320, 640, 1280), image_format='webp', quality=80, workers=4):
+        self.cache_dir = Path(data_dir, 'derivatives')
+        self.widths = tuple(widths)
+        self.image_format = image_format
+        self.quality = quality
+        self.workers = max(1, workers)
+        if Image is None:
+            logger.warning('Pillow is not installed, images will be served as they are')
+
+    def cache_path(self, attachment):
+        return Path(self.cache_dir, f'{attachment.id_}-{attachment.version}')
+
+    def derive(self, images):
+        '''
+        Take (source path, attachment record) pairs and return {attachment id: [(width, height, path)]}
+        '''
+        if Image is None or not images:
+            return {}
+        derived = {}
+        to_build = []
+        for source, attachment in images:
+            cache_path = self.cache_path(attachment)
+            index_file = Path(cache_path, 'index.json')
+            if index_file.exists():
+                derived[attachment.id_] = (cache_path, loads(index_file.read_bytes()))
+            else:
+                to_build.append((source, attachment, cache_path))
+        if to_build:
+            logger.info('Building derivatives of %d images', len(to_build))
+            with process_pool(self.workers) as pool:
+                futures = [
+                    (attachment, cache_path, pool.submit(
+                        build_derivatives, str(source), str(cache_path), self.widths, self.image_format, self.quality
+                    ))
+                    for source, attachment, cache_path in to_build
+                ]
+                for attachment, cache_path, future in futures:
+                    derived[attachment.id_] = (cache_path, future.result())
+        return {
+            attachment_id: [(width, height, Path(cache_path, name)) for width, height, name in built]
+            for attachment_id, (cache_path, built) in derived.items()
+        }
+
+    def prune(self, attachments):
+        '''
+        Remove cached derivatives of attachment versions we no longer hold
+        '''
+        if not self.cache_dir.exists():
+            return
+        keep = set(self.cache_path(attachment).name for attachment in attachments)
+        for cache_path in self.cache_dir.iterdir():
+            if cache_path.name not in keep:
+                logger.debug('Removing derivatives %s', cache_path.name)
+                for path in cache_path.iterdir():
+                    path.unlink()
+                cache_path.rmdir()
@@ -0,0 +1,108 @@
+import re
+import logging
+from datetime import datetime
+from collections import defaultdict
+
+
+logger = logging.getLogger(f'{__package__}.{__name__}')
+string_unpack = re.compile(r'(?<!\|)\|(?!\|)')  # How pydal stores list:string fields
+
+
+def decode_list(value):
+    if not value:
+        return []
+    return [item.replace('||', '|') for item in string_unpack.split(value[1:-1]) if item.strip()]
+
+
+def decode_datetime(value):
+    # pydal connects with detect_types=PARSE_DECLTYPES, so sqlite3 usually hands back datetimes already
+    if not value or isinstance(value, datetime):
+        return value or None
+    return datetime.fromisoformat(value)
+
+
+class Record:
+    '''
+    A Store row as a plain object with __slots__, in place of a dict backed pydal Row. Built
+    from a raw query by Store.load_index(), with parent already the row id of the parent.
+    '''
+    __slots__ = ()
+    decoders = {}  # Column name to a function that turns what SQLite returns into what pydal would
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(*(
+            cls.decoders[name](value) if name in cls.decoders else value
+            for name, value in zip(cls.__slots__, row)
+        ))
+
+    @classmethod
+    def select(cls, table):
+        return f'SELECT {", ".join(cls.__slots__)} FROM {table}'
+
+    def __repr__(self):
+        return f'<{type(self).__name__} {self.id_}>'
+
+
+class ContentRecord(Record):
+    __slots__ = (
+        'id', 'id_', 'type', 'title', 'slug', 'level', 'parent', 'labels', 'version',
+        'created', 'modified', 'links_version', 'html_fingerprint', 'path'
+    )
+    decoders = {'labels': decode_list, 'created': decode_datetime, 'modified': decode_datetime}
+
+
+class AttachmentRecord(Record):
+    __slots__ = ('id', 'id_', 'parent', 'title', 'version', 'created', 'modified', 'path_current', 'sha256')
+    decoders = {'created': decode_datetime, 'modified': decode_datetime}
+
+
+class ContentIndex:
+    '''
+    Everything in the Store loaded up front, with parent/child and attachment lookups
+    kept in memory so exporting never has to go back to SQLite.
+    '''
+    def __init__(self, contents, attachments):
+        self.contents = list(contents)
+        self.by_row_id = {record.id: record for record in self.contents}
+        self.by_id = {record.id_: record for record in self.contents}
+        self.children = defaultdict(list)
+        self.attachments = defaultdict(list)
+        for record in self.contents:
+            if record.parent:
+                self.children[int(record.parent)].append(record)
+        for attachment in attachments:
+            self.attachments[int(attachment.parent)].append(attachment)
+        logger.debug('Indexed %d content and %d attachments', len(self.contents), len(attachments))
+
+    def parent(self, record):
+        return self.by_row_id.get(int(record.parent)) if record.parent else None
+
+    def parent_id(self, record):
+        parent = self.parent(record)
+        return parent.id_ if parent else None
+
+    def ancestors(self, record):
+        '''
+        Parents of record, nearest first
+        '''
+        ancestors = []
+        parent = self.parent(record)
+        while parent is not None:
+            ancestors.append(parent)
+            parent = self.parent(parent)
+        return ancestors
+
+    def pages(self, min_level=0, max_level=1000):
+        for record in self.contents:
+            if record.type == 'page' and record.level is not None and min_level <= record.level <= max_level:
+                yield (record, self.attachments[record.id])
+
+    def blog(self):
+        for record in self.contents:
+            if record.type == 'blogpost':
+                yield (record, self.attachments[record.id])
@@ -0,0 +1,102 @@
+import os
+import hashlib
+import logging
+from pathlib import Path
+from json import dumps, loads
+from concurrent.futures import ThreadPoolExecutor
+
+
+logger = logging.getLogger(f'{__package__}.{__name__}')
+
+
+class Manifest:
+    '''
+    The sha256, size and mtime of every file under a directory (normally Pelican's output), so
+    one build of the site can be compared with another and only the difference published.
+    '''
+    def __init__(self, files=None):
+        self.files = files or {}
+
+    @classmethod
+    def load(cls, path):
+        path = Path(path)
+        if not path.exists():
+            return None
+        with path.open('rb') as fh:
+            return cls(loads(fh.read().decode('utf-8'))['files'])
+
+    @classmethod
+    def scan(cls, root, previous=None, workers=4):
+        '''
+        Hash everything under root, reusing previous hashes for files whose size and mtime haven't moved.
+        With DELETE_OUTPUT_DIRECTORY (as in our pelicanconf.py) Pelican rewrites every file, so every
+        mtime moves and everything is hashed again; the reuse only pays off when Pelican leaves
+        unchanged files alone.
+        '''
+        root = Path(root)
+        known = previous.files if previous else {}
+        stats = {}
+        for dirpath, _, filenames in os.walk(root):
+            for filename in filenames:
+                full_path = Path(dirpath, filename)
+                stats[full_path.relative_to(root).as_posix()] = full_path.stat()
+
+        files, to_hash = {}, []
+        for rel_path, st in stats.items():
+            entry = known.get(rel_path)
+            if entry and entry['size'] == st.st_size and entry['mtime_ns'] == st.st_mtime_ns:
+                files[rel_path] = entry
+            else:
+                to_hash.append(rel_path)
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for rel_path, digest in zip(to_hash, pool.map(lambda p: cls.file_sha256(Path(root, p)), to_hash)):
+                files[rel_path] = {
+                    'sha256': digest,
+                    'size': stats[rel_path].st_size,
+                    'mtime_ns': stats[rel_path].st_mtime_ns
+                }
+        logger.debug('Hashed %d of %d files under %s', len(to_hash), len(files), root)
+        return cls(dict(sorted(files.items())))
+
+    @staticmethod
+    def file_sha256(path):
+        digest = hashlib.sha256()
+        with open(path, 'rb') as fh:
+            for chunk in iter(lambda: fh.read(1024 * 1024), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def save(self, path):
+        with Path(path).open('wb') as fh:
+            fh.write(dumps({'files': self.files}, indent=1).encode('utf-8'))
+
+    def diff(self, previous):
+        '''
+        Files added, changed and removed since previous (everything is added if there is no previous)
+        '''
+        before = previous.files if previous else {}
+        return {
+            'added': [p for p in self.files if p not in before],
+            'changed': [p for p in self.files if p in before and before[p]['sha256'] != self.files[p]['sha256']],
+            'removed': [p for p in before if p not in self.files]
+        }
+
+    def write_changes(self, previous, publish_dir):
+        '''
+        Write upload.txt (added and changed) and removed.txt into publish_dir for publish.sh
+        '''
+        changes = self.diff(previous)
+        publish_dir = Path(publish_dir)
+        publish_dir.mkdir(parents=True, exist_ok=True)
+        for name, paths in (
+            ('upload.txt', changes['added'] + changes['changed']),
+            ('removed.txt', changes['removed'])
+        ):
+            with Path(publish_dir, name).open('w') as fh:
+                fh.write(''.join(f'{p}\n' for p in paths))
+        logger.info(
+            'Output has %d added, %d changed and %d removed files since the last publish',
+            len(changes['added']), len(changes['changed']), len(changes['removed'])
+        )
+        return changes
@@ -7,15 +7,38 @@ from lxml.html.builder import HTML, HEAD, BODY, META, TITLE
 from bs4 import BeautifulSoup
 
 logger = logging.getLogger(f'{__package__}.{__name__}')
+PAGE_LINK_RE = re.compile(r'viewpage\.action\?pageId=(\d+)')
+ANCHOR_RE = re.compile(r'<a\s[^>]*>')
+ATTACHMENT_LINK_RE = re.compile(r'\shref="[^"]*/download/attachments/[^"]*"')
+RESOURCE_ID_RE = re.compile(r'\sdata-linked-resource-id="(\d+)"')
+IMAGE_SRC_RE = re.compile(r'<img[^>]*\ssrc="[^"]*download/attachments/[^"]*?([^/"?]+)(?:\?[^"]*)?"')
 
 
-class Massage:
+def link_keys(content_json):
+    '''
+    The export_files keys that Massage will look up when rewriting this content's links, found
+    with a few regular expressions over the raw body rather than a full parse.
+    '''
+    body = content_json['body']['export_view']['value'] or ''
+    keys = set(PAGE_LINK_RE.findall(body))
+    for anchor in ANCHOR_RE.findall(body):
+        # Page links and user mentions carry a data-linked-resource-id too, only downloads are attachments
+        if ATTACHMENT_LINK_RE.search(anchor):
+            keys.update(f'att{attachment_id}' for attachment_id in RESOURCE_ID_RE.findall(anchor))
+    for href in IMAGE_SRC_RE.findall(body):
+        keys.update((f'{content_json["id"]}/{href}', href))
+    return sorted(keys)
+
+
+class Document:
+    '''
+    The lxml document for a piece of content, shared by Massage and Transform
+    '''
     def __init__(self, content_json, label_list, destination, export_files):
         self.content = content_json
         self.export_files = export_files
         self.destination = destination
         self.document = self.document_from_json(content_json, label_list)
-        self.soup = BeautifulSoup(lxml.html.tostring(self.document), 'lxml')
 
     def relative_path(self, path):
         # Why is os.path.relpath better than Path.relative_to ??
@@ -38,6 +61,12 @@ class Massage:
             )
         )
 
+
+class Massage(Document):
+    def __init__(self, content_json, label_list, destination, export_files):
+        super().__init__(content_json, label_list, destination, export_files)
+        self.soup = BeautifulSoup(lxml.html.tostring(self.document), 'lxml')
+
     def convert_code_to_prettyprint(self):
         for pre in self.soup.find_all('pre'):
             if 'syntaxhighlighter-pre' in pre['class']:
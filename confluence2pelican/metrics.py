@@ -0,0 +1,112 @@
+import time
+import heapq
+import logging
+import threading
+from pathlib import Path
+from json import dumps
+from contextlib import contextmanager
+
+
+logger = logging.getLogger(f'{__package__}.{__name__}')
+
+
+class Metrics:
+    '''
+    Stage timings, counters and the slowest individual items, collected from anywhere in
+    confluence2pelican via the module level `metrics` and written out as a JSON report.
+    '''
+    def __init__(self, keep_slowest=20):
+        self.keep_slowest = keep_slowest
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.stages = {}
+            self.counters = {}
+            self.slowest = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.stages[name] = self.stages.get(name, 0.0) + elapsed
+            logger.debug('%s took %.3fs', name, elapsed)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, seconds, item):
+        '''
+        Record how long item took for name, keeping only the slowest few
+        '''
+        with self.lock:
+            slowest = self.slowest.setdefault(name, [])
+            if len(slowest) < self.keep_slowest:
+                heapq.heappush(slowest, (seconds, str(item)))
+            elif seconds > slowest[0][0]:
+                heapq.heapreplace(slowest, (seconds, str(item)))
+
+    def report(self, prefix='', **extra):
+        '''
+        Everything collected so far, or with prefix only the names starting with it (prefix removed)
+        '''
+        def own(items):
+            return {name[len(prefix):]: value for name, value in items if name.startswith(prefix)}
+
+        with self.lock:
+            report = {
+                'started': self.started,
+                'finished': time.time(),
+                'stages': own(self.stages.items()),
+                'counters': own(sorted(self.counters.items())),
+                'slowest': {
+                    name: [{'item': item, 'seconds': seconds} for seconds, item in sorted(items, reverse=True)]
+                    for name, items in own(self.slowest.items()).items()
+                }
+            }
+        report.update(extra)
+        return report
+
+    def write(self, path, prefix='', **extra):
+        with Path(path).open('wb') as fh:
+            fh.write(dumps(self.report(prefix, **extra), indent=2).encode('utf-8'))
+        logger.info('Wrote metrics to %s', path)
+
+    def scoped(self, prefix):
+        return ScopedMetrics(self, prefix) if prefix else self
+
+
+class ScopedMetrics:
+    '''
+    The metrics of one space when several are synced at once: names are prefixed on their way into
+    the shared Metrics, so the totals don't mix, and report() holds just this space's with the
+    prefix removed again.
+    '''
+    def __init__(self, metrics, prefix):
+        self.metrics = metrics
+        self.prefix = prefix
+
+    def stage(self, name):
+        return self.metrics.stage(f'{self.prefix}{name}')
+
+    def count(self, name, n=1):
+        self.metrics.count(f'{self.prefix}{name}', n)
+
+    def observe(self, name, seconds, item):
+        self.metrics.observe(f'{self.prefix}{name}', seconds, item)
+
+    def report(self, **extra):
+        return self.metrics.report(self.prefix, **extra)
+
+    def write(self, path, **extra):
+        self.metrics.write(path, self.prefix, **extra)
+
+
+metrics = Metrics()
@@ -0,0 +1,12 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+
+def process_pool(max_workers, **kwargs):
+    '''
+    A ProcessPoolExecutor whose workers are started by a fork server (or spawned where there isn't
+    one) rather than forked from us: spaces are exported in threads, and a process forked while
+    another thread holds a lock inherits that lock held, with nobody left to release it.
+    '''
+    method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context(method), **kwargs)
@@ -1,105 +1,387 @@
 import logging
 import itertools
+from collections import deque
 from pathlib import Path
 from json import dumps
-import requests
+from .crawl import Crawler
+from .download import Downloader
+from .transport import Transport
+from .metrics import metrics as default_metrics
 
 
 logger = logging.getLogger(f'{__package__}.{__name__}')
 
 
+class SlurpError(Exception):
+    pass
+
+
 class Slurp:
-    def __init__(self, url, username, password, space_key):
+    def __init__(self, url, username, password, space_key, concurrency=8, download_workers=4,
+                 blog_page_size=50, blog_prefetch=2, retries=5, rate_limit=None, transport=None, crawler=None,
+                 metrics=None):
+        '''
+        Pass a transport and crawler to share one connection pool and request budget between spaces,
+        and metrics (see Metrics.scoped()) to keep each space's counters apart
+        '''
         self.space_key = space_key
+        self.metrics = metrics or default_metrics
         self.url = url if not url.endswith('/') else url[0:-1]
-        self.session = requests.Session()
-        self.session.auth = (username, password)
+        self.crawler = crawler or Crawler(concurrency)
+        self.transport = transport or Transport(
+            self.url, (username, password),
+            pool_size=self.crawler.concurrency + download_workers,
+            retries=retries,
+            rate=rate_limit
+        )
+        self.session = self.transport.session
+        self.downloader = Downloader(self.get, workers=download_workers, metrics=self.metrics)
+        self.batch_size = 200
+        self.blog_page_size = blog_page_size
+        self.blog_prefetch = max(1, blog_prefetch)
         self.content_expands = ','.join([
             'version,metadata.labels,history,children.page,body.export_view',
             'children.attachment,children.attachment.version,children.attachment.history',
         ])
     
-    def slurp(self, store=None):
-        for content in itertools.chain(self.recurse_pages(self.get_homepage_id()), self.recurse_blogs()):
+    def slurp(self, store=None, incremental=False, since=None):
+        '''
+        Fetch the space into store. With since (a CQL date such as "2020-01-01" or now("-4w")) only
+        blog posts modified since then are fetched on a full slurp and older ones are kept as they are.
+        '''
+        unchanged = []
+        if store:
+            store.begin_run()
+        if incremental and store:
+            contents = self.changed_content(store, unchanged)
+        else:
+            if since and store:
+                store.keep_content_type('blogpost')
+            contents = itertools.chain(self.crawl_pages(self.get_homepage_id()), self.recurse_blogs(since=since))
+        batch = []
+        for content in contents:
             logger.debug('Content: %s', {k: v for k, v in content.items() if k != 'json'})
-            if store:
-                store.store_content(content)
-            for attachment in self.attachments_from_content(content['json']):
-                logger.debug('Attachment: %s', {k: v for k, v in attachment.items() if k != 'json'})
-                if store:
-                    store.store_attachment(content, attachment)
+            self.metrics.count(f'slurp.{content["type"]}.fetched')
+            batch.append(content)
+            if len(batch) >= self.batch_size:
+                self.store_batch(store, batch)
+                batch = []
+        self.store_batch(store, batch)
+
+        # Only now is every new parent stored, so an unchanged page moved under one can find it
+        for listed in unchanged:
+            store.touch_content(listed)
 
         if store:
-            store.commit()
+            with self.metrics.stage('slurp.wait_for_downloads'):
+                downloaded = self.downloader.wait()
+            with self.metrics.stage('slurp.store'):
+                for attachment_id, digest in downloaded:
+                    store.store_blob(attachment_id, digest)
+                store.commit()
+        for endpoint, stats in self.transport.report().items():
+            logger.info(
+                '%s: %d requests, %d errors, %.3fs mean, %.3fs max',
+                endpoint, stats['requests'], stats['errors'], stats['mean_seconds'], stats['max_seconds']
+            )
     
+    def store_batch(self, store, contents):
+        with self.metrics.stage('slurp.store'):
+            if store:
+                store.store_contents(contents)
+            for content in contents:
+                attachments = list(self.attachments_from_content(content['json']))
+                for attachment in attachments:
+                    logger.debug('Attachment: %s', {k: v for k, v in attachment.items() if k != 'json'})
+                if not store:
+                    continue
+                for attachment, download_path in zip(attachments, store.store_attachments(content, attachments)):
+                    if download_path:
+                        self.metrics.count('slurp.attachment.queued')
+                        self.downloader.submit(
+                            attachment['id'], attachment['download'], download_path, attachment['size']
+                        )
+                    else:
+                        self.metrics.count('slurp.attachment.skipped')
+
     def get(self, path, **kwargs):
         path = path if not path.startswith('/') else path[1:]
-        return self.session.get(f'{self.url}/{path}', **kwargs)
+        return self.transport.get(f'{self.url}/{path}', **kwargs)
 
     def get_content(self, page_id):
         page_res = self.get(f'rest/api/content/{page_id}?expand=body.export_view,version,history,metadata.labels')
         if page_res.status_code < 300:
             return page_res.json()
 
-    def get_homepage_id(self):
-        res = self.get(f'rest/api/space/{self.space_key}?expand=homepage')
-        if res.status_code == 200:
-            homepage_id = res.json()['homepage']['id']
-            logger.debug(f'homepage id is {homepage_id}')
-            return homepage_id
-
-    def recurse_pages(self, page_id, parent_id=None, level=0):
-        res = self.get(f'rest/api/content/{page_id}?expand={self.content_expands}')
-        if res.status_code == 200:
-            page_json = res.json()
-            yield {
-                'id': page_id,
-                'type': 'page',
-                'level': level,
-                'parent': parent_id,
-                'title': page_json['title'],
-                'version': page_json['version']['number'],
-                'json': page_json,
-                'labels': self.labels_from_content(page_json)
-            }
-            if page_json['children']['page']['size']:
-                for child in page_json['children']['page']['results']:
-                    yield from self.recurse_pages(child['id'], page_id, level+1)
+    def content_from_json(self, content_json, parent_id=None, level=None):
+        content = {
+            'id': content_json['id'],
+            'type': content_json['type'],
+            'title': content_json['title'],
+            'version': content_json['version']['number'],
+            'json': content_json,
+            'labels': self.labels_from_content(content_json)
+        }
+        if content['type'] == 'page':
+            content['level'] = level
+            content['parent'] = parent_id
+        return content
 
-    def recurse_blogs(self):
+    def list_content(self, content_type):
+        '''
+        Cheap listing of every item of content_type in the space, without bodies or history.
+        Only enough is expanded to tell whether our stored copy is out of date.
+        '''
         params = {
-            'cql': f'space.key = {self.space_key} AND type = blogpost',
-            'expand': self.content_expands,
-            'limit': 50,
+            'spaceKey': self.space_key,
+            'type': content_type,
+            'expand': 'version,ancestors,metadata.labels,children.attachment.version',
+            'limit': 100,
             'start': 0
         }
         while True:
-            res = self.get('rest/api/content/search', params=params)
+            res = self.get('rest/api/content', params=params)
             if res.status_code != 200:
-                break
+                raise SlurpError(f'listing {content_type} content failed with HTTP {res.status_code}')
             res_json = res.json()
-            for blog_json in res_json['results']:
+            for content_json in self.crawler.map(self.complete_listing, res_json['results']):
                 yield {
-                    'id': blog_json['id'],
-                    'type': 'blogpost',
-                    'title': blog_json['title'],
-                    'version': blog_json['version']['number'],
-                    'json': blog_json,
-                    'labels': self.labels_from_content(blog_json)
+                    'id': content_json['id'],
+                    'type': content_type,
+                    'title': content_json['title'],
+                    'version': content_json['version']['number'],
+                    'ancestors': [a['id'] for a in content_json.get('ancestors', [])],
+                    'labels': self.labels_from_content(content_json),
+                    'attachments': {
+                        a['id']: a['version']['number'] for a in content_json['children']['attachment']['results']
+                    }
+                }
+            if self.last_page(res_json):
+                break
+            params['start'] += res_json['size']
+
+    def last_page(self, res_json):
+        '''
+        Whether res_json is the last page of a listing or search. Confluence may cap the limit we ask
+        for, so follow its next link when there is one and otherwise compare with the limit it applied.
+        '''
+        if not res_json['results']:
+            return True
+        if 'next' in res_json.get('_links', {}):
+            return False
+        return 'limit' in res_json and res_json['size'] < res_json['limit']
+
+    def place_page(self, page, homepage_id):
+        '''
+        Set level and parent on a listed page from its ancestors, False if it isn't under the homepage
+        '''
+        if page['id'] == homepage_id:
+            page['level'], page['parent'] = 0, None
+        elif homepage_id in page['ancestors']:
+            page['level'] = len(page['ancestors']) - page['ancestors'].index(homepage_id)
+            page['parent'] = page['ancestors'][-1]
+        else:
+            return False  # crawl_pages() would never have found this page either
+        return True
+
+    def list_pages(self, homepage_id):
+        pages = [page for page in self.list_content('page') if self.place_page(page, homepage_id)]
+        return sorted(pages, key=lambda p: p['level'])  # parents must be stored before their children
+
+    def recently_modified(self, minutes, homepage_id):
+        '''
+        Pages and blog posts modified in the last few minutes (CQL only has minute resolution), as
+        cheap listings with just their version and ancestors
+        '''
+        cql = f'space.key = {self.space_key} AND type in (page, blogpost) AND lastmodified >= now("-{minutes}m")'
+        start, limit = 0, 100
+        while True:
+            res_json = self.search_content(cql, start, limit, expand='version,ancestors')
+            for content_json in res_json['results']:
+                listed = {
+                    'id': content_json['id'],
+                    'type': content_json['type'],
+                    'title': content_json['title'],
+                    'version': content_json['version']['number'],
+                    'ancestors': [a['id'] for a in content_json.get('ancestors', [])]
                 }
-            if res_json['size'] < params['limit']:
+                if listed['type'] != 'page' or self.place_page(listed, homepage_id):
+                    yield listed
+            if self.last_page(res_json):
+                break
+            start += res_json['size']
+
+    def refresh(self, store, listed):
+        '''
+        Fetch and store just the listed content (see recently_modified()) and its attachments. Nothing
+        else in store is touched, so a full slurp() is still needed now and then to notice deletions.
+        '''
+        listed = sorted(listed, key=lambda l: l.get('level') or 0)
+        contents = [
+            self.content_from_json(content_json, l.get('parent'), l.get('level'))
+            for l, content_json in zip(listed, self.crawler.map(self.get_content_json, [l['id'] for l in listed]))
+            if content_json is not None
+        ]
+        for content in contents:
+            self.metrics.count(f'slurp.{content["type"]}.fetched')
+        self.store_batch(store, contents)
+        with self.metrics.stage('slurp.wait_for_downloads'):
+            downloaded = self.downloader.wait()
+        for attachment_id, digest in downloaded:
+            store.store_blob(attachment_id, digest)
+        store.save()
+        return contents
+
+    def changed_content(self, store, unchanged):
+        '''
+        Yield content that is new or out of date in store, appending the listings of everything
+        else to unchanged. Those must be touched (see Store.touch_content()) only once all of the
+        yielded content is stored, as a page may have been moved under a parent that is new.
+        '''
+        known = store.content_versions()
+        stale = []
+        for listed in itertools.chain(self.list_pages(self.get_homepage_id()), self.list_content('blogpost')):
+            if known.get(listed['id']) == (listed['version'], listed['attachments']):
+                logger.debug('Unchanged: %s (%s)', listed['id'], listed['title'])
+                self.metrics.count(f'slurp.{listed["type"]}.unchanged')
+                unchanged.append(listed)
+            else:
+                stale.append(listed)
+        for listed, content_json in zip(stale, self.crawler.map(self.get_content_json, [l['id'] for l in stale])):
+            if content_json is not None:
+                yield self.content_from_json(content_json, listed.get('parent'), listed.get('level'))
+
+    def get_homepage_id(self):
+        res = self.get(f'rest/api/space/{self.space_key}?expand=homepage')
+        if res.status_code != 200:
+            raise SlurpError(f'could not find the homepage of {self.space_key} (HTTP {res.status_code})')
+        homepage_id = res.json()['homepage']['id']
+        logger.debug(f'homepage id is {homepage_id}')
+        return homepage_id
+
+    def get_content_json(self, content_id):
+        '''
+        Fetch content with everything we store expanded. Content that has gone (404) is skipped, but
+        anything else is an error: carrying on would have Store.commit() delete the content we missed.
+        '''
+        res = self.get(f'rest/api/content/{content_id}?expand={self.content_expands}')
+        if res.status_code == 200:
+            return self.complete_content(res.json())
+        if res.status_code != 404:
+            raise SlurpError(f'fetching {content_id} failed with HTTP {res.status_code}')
+        logger.warning('%s has gone away, skipping it', content_id)
+
+    def child_page_ids(self, page_json):
+        if not page_json['children']['page']['size']:
+            return []
+        return [child['id'] for child in page_json['children']['page']['results']]
+
+    def crawl_pages(self, page_id):
+        for page_id, parent_id, level, page_json in self.crawler.walk(
+            page_id, self.get_content_json, self.child_page_ids
+        ):
+            yield self.content_from_json(page_json, parent_id, level)
+
+    def search_content(self, cql, start, limit, expand=None):
+        res = self.get('rest/api/content/search', params={
+            'cql': cql,
+            'expand': expand or self.content_expands,
+            'limit': limit,
+            'start': start
+        })
+        if res.status_code != 200:
+            raise SlurpError(f'searching for {cql} failed with HTTP {res.status_code}')
+        return res.json()
+
+    def recurse_blogs(self, since=None):
+        '''
+        Page through the blog posts, keeping the next blog_prefetch pages in flight while the current
+        one is processed. Confluence may cap blog_page_size, so nothing is prefetched until the first
+        page tells us the limit it applied; if it also tells us the totalSize we fan out to every page.
+        '''
+        cql = f'space.key = {self.space_key} AND type = blogpost'
+        if since:
+            cql += f' AND lastmodified >= {since}' if since.startswith('now(') else f' AND lastmodified >= "{since}"'
+        res_json = self.search_content(cql, 0, self.blog_page_size)
+        limit = res_json.get('limit') or self.blog_page_size
+        fan_out = 'totalSize' in res_json
+        in_flight = deque()
+        next_start = res_json['size']
+
+        def submit():
+            nonlocal next_start
+            in_flight.append(self.crawler.pool.submit(self.search_content, cql, next_start, limit))
+            next_start += limit
+
+        if fan_out:
+            while next_start < res_json['totalSize']:
+                submit()
+        try:
+            while True:
+                last = self.last_page(res_json)
+                if not fan_out and not last:
+                    while len(in_flight) < self.blog_prefetch:
+                        submit()
+                for blog_json in self.crawler.map(self.complete_content, res_json['results']):
+                    yield self.content_from_json(blog_json)
+                if not in_flight or (last and not fan_out):
+                    break
+                res_json = in_flight.popleft().result()
+        finally:
+            for future in in_flight:
+                future.cancel()
+
+    def truncated(self, expansion):
+        return not expansion.get('complete') and not expansion['size'] < expansion['limit']
+
+    def fetch_remaining(self, path, expansion, params=None):
+        '''
+        Page through path for whatever didn't fit in an embedded expansion (a dict of results, size
+        and limit), adding it to the expansion's results and marking the expansion complete
+        '''
+        params = dict(params or {}, start=expansion['size'], limit=max(expansion['limit'], 25))
+        while True:
+            res = self.get(path, params=params)
+            if res.status_code != 200:
+                raise SlurpError(f'fetching {path} failed with HTTP {res.status_code}')
+            res_json = res.json()
+            expansion['results'].extend(res_json['results'])
+            if self.last_page(res_json):
                 break
-            params['start'] += params['limit']
+            params['start'] += res_json['size']
+        expansion['size'] = len(expansion['results'])
+        expansion['complete'] = True
+
+    def complete_content(self, content_json, attachment_expand='version,history'):
+        '''
+        Fetch the rest of the labels and attachments of content_json when they didn't fit in the first
+        page of its expansions. This is called from the crawler's threads (or via crawler.map()), so
+        the extra round trips for different content run concurrently.
+        '''
+        labels = content_json['metadata']['labels']
+        if self.truncated(labels):
+            self.metrics.count('slurp.labels.paged')
+            self.fetch_remaining(f'rest/api/content/{content_json["id"]}/label', labels)
+        attachments = content_json['children']['attachment']
+        if self.truncated(attachments):
+            self.metrics.count('slurp.attachments.paged')
+            self.fetch_remaining(
+                f'rest/api/content/{content_json["id"]}/child/attachment', attachments, {'expand': attachment_expand}
+            )
+        return content_json
+
+    def complete_listing(self, content_json):
+        return self.complete_content(content_json, attachment_expand='version')
 
     def labels_from_content(self, content):
         labels = [l['name'] for l in content['metadata']['labels']['results']]
-        if not content['metadata']['labels']['size'] < content['metadata']['labels']['limit']:
+        if self.truncated(content['metadata']['labels']):
             logger.warning('Probably more labels for %s (%s)', content['id'], content['title'])
         return labels
     
     def attachments_from_content(self, content):
         attachments = content['children']['attachment']['results']
-        if not content['children']['attachment']['size'] < content['children']['attachment']['limit']:
+        if self.truncated(content['children']['attachment']):
             logger.warning('Probably more attachments for %s (%s)', content['id'], content['title'])
         for attachment_json in attachments:
             yield {
@@ -110,5 +392,5 @@ class Slurp:
                 'size': attachment_json['extensions']['fileSize'],
                 'json': attachment_json,
                 'parent': content['id'],
-                'stream': lambda: self.get(attachment_json['_links']['download'], stream=True)
+                'download': attachment_json['_links']['download']
             }
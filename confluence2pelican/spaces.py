@@ -0,0 +1,69 @@
+import logging
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from .store import Store
+from .watch import Watcher
+from .metrics import metrics as default_metrics
+
+
+logger = logging.getLogger(f'{__package__}.{__name__}')
+
+
+def space_data_dir(data_dir, space_key, partitioned):
+    '''
+    Where a space keeps its Store, exports and output: data_dir itself for a single space, or
+    data_dir/spaces/<space key> when several are synced side by side
+    '''
+    return Path(data_dir, 'spaces', space_key) if partitioned else Path(data_dir)
+
+
+class SpacePipeline:
+    '''
+    The Slurp and Export of one space plus its Store, which is opened by the thread that runs the
+    pipeline (SQLite connections belong to the thread that made them).
+    '''
+    def __init__(self, space_key, data_dir, slurp, export, metrics=None):
+        self.space_key = space_key
+        self.data_dir = Path(data_dir)
+        self.slurp = slurp
+        self.export = export
+        self.metrics = metrics or default_metrics  # Shared with slurp and export, see Metrics.scoped()
+        self.store = None
+
+    def open_store(self):
+        if self.store is None:
+            self.store = Store(self.data_dir)
+        return self.store
+
+    def run(self, slurp=False, incremental=False, since=None, export=False):
+        store = self.open_store()
+        if slurp:
+            with self.metrics.stage('slurp'):
+                self.slurp.slurp(store=store, incremental=incremental, since=since)
+        if export:
+            with self.metrics.stage('export'):
+                self.export.export(store=store)
+
+    def watch(self, **kwargs):
+        Watcher(
+            self.slurp, self.open_store(), self.export,
+            metrics_file=Path(self.data_dir, 'metrics.json'), metrics=self.metrics, **kwargs
+        ).run()
+
+
+def run_pipelines(pipelines, method, **kwargs):
+    '''
+    Call method on each pipeline, in parallel threads when there is more than one
+    '''
+    if len(pipelines) == 1:
+        return [getattr(pipelines[0], method)(**kwargs)]
+    with ThreadPoolExecutor(max_workers=len(pipelines), thread_name_prefix='space') as pool:
+        futures = [(pipeline, pool.submit(getattr(pipeline, method), **kwargs)) for pipeline in pipelines]
+        results = []
+        for pipeline, future in futures:
+            try:
+                results.append(future.result())
+            except Exception:
+                logger.exception('%s failed for space %s', method, pipeline.space_key)
+                raise
+        return results
@@ -1,12 +1,17 @@
 import os
+import hashlib
 import logging
 import uuid
 import shutil
 from pathlib import Path
-from json import dumps
+from types import SimpleNamespace
+from json import dumps, loads
 import pendulum
 from slugify import slugify
 from .dal import setup_database
+from .index import ContentIndex, ContentRecord, AttachmentRecord
+from .compact import compact
+from .massage import link_keys
 
 logger = logging.getLogger(f'{__package__}.{__name__}')
 
@@ -18,7 +23,13 @@ class Store:
         self.db = setup_database(self.data_dir, 'store_db', 'store.sqlite3', {
             'content': {
                 'id_': 'string',
-                'json': 'string',
+                'json': 'string',  # Full json as stored by older versions, see compact()
+                'meta': 'text',
+                'body': 'text',
+                'html': 'text',  # Massaged body saved by Export(target='store')
+                'html_fingerprint': 'string',
+                'path': 'string',
+                'links_version': 'integer',  # Version the link table rows were extracted from
                 'run': 'string',
                 'version': 'integer',
                 'created': 'datetime',
@@ -41,10 +52,31 @@ class Store:
                 'title': 'string',
                 'path_all': 'string',
                 'path_current': 'string',
+                'sha256': 'string',
                 'parent': 'reference content',
                 'deleted': 'boolean'
+            },
+            'link': {
+                'source': 'reference content',
+                'target': 'string'  # An Export.export_files key, see massage.link_keys()
             }
+        }, indexes={
+            'content': ['id_', 'parent', 'type', 'level', 'run'],
+            'attachment': ['id_', 'parent', 'sha256', 'run'],
+            'link': ['source', 'target']
         })
+        self.content_ids = None
+        self.attachment_rows = None
+        self.changed_links = None  # Row ids whose links changed since take_changed_links(), None for everything
+        self.blob_dir = Path(self.data_dir, 'attachments', 'blobs')
+        self.incoming_dir = Path(self.data_dir, 'attachments', 'incoming')
+
+    def begin_run(self):
+        '''
+        Start a new run, so the next commit() drops whatever this run doesn't store or touch. A Store
+        kept open across slurps (as in watch mode) would otherwise keep everything it ever held.
+        '''
+        self.instance_id = str(uuid.uuid4())
 
     def validate_dict(self, item):
         return isinstance(item, dict) and 'json' in item
@@ -52,79 +84,334 @@ class Store:
     def commit(self):
         self.db(self.db.content.run != self.instance_id).delete()
         self.db(self.db.attachment.run != self.instance_id).delete()
+        self.db(~self.db.link.source.belongs(self.db(self.db.content)._select(self.db.content.id))).delete()
+        self.prune_blobs()
+        compacted = self.compact()
+        self.content_ids = None
+        self.attachment_rows = None
+        self.changed_links = None
+        result = self.db.commit()
+        if compacted:
+            logger.info('Compacted %d records, vacuuming the database', compacted)
+            self.db.executesql('VACUUM')
+        return result
+
+    def save(self):
+        '''
+        Commit changes made outside of a slurp, without cleaning up content this run hasn't seen
+        '''
         return self.db.commit()
 
+    def store_html(self, content_id, path, html, fingerprint):
+        self.db(self.db.content.id_==content_id).update(html=html, html_fingerprint=fingerprint, path=str(path))
+
+    def clear_html(self):
+        self.db(self.db.content.html != None).update(html=None, html_fingerprint=None, path=None)
+
+    def store_links(self, record_id, keys, version):
+        '''
+        Replace the outbound links of a content row with keys, extracted from the given version of it
+        '''
+        self.db(self.db.link.source==record_id).delete()
+        if keys:
+            self.db.link.bulk_insert([{'source': record_id, 'target': key} for key in keys])
+        self.db(self.db.content.id==record_id).update(links_version=version)
+        if self.changed_links is not None:
+            self.changed_links.add(record_id)
+
+    def take_changed_links(self):
+        '''
+        Row ids whose links have changed since the last call, or None if anything may have (after a
+        commit(), or the first time), so a caller can keep a link_map() up to date
+        '''
+        changed, self.changed_links = self.changed_links, set()
+        return changed
+
+    def link_map(self, sources=None):
+        '''
+        Content row id to the sorted keys it links to, for everything in the link table (or just sources)
+        '''
+        links = {}
+        cursor = self.db._adapter.connection.cursor()
+        try:
+            if sources is None:
+                cursor.execute('SELECT source, target FROM link ORDER BY source, target')
+                rows = cursor
+            else:
+                sources, rows = list(sources), []
+                for start in range(0, len(sources), 500):
+                    chunk = sources[start:start + 500]
+                    cursor.execute(
+                        f'SELECT source, target FROM link WHERE source IN ({",".join("?" * len(chunk))}) '
+                        'ORDER BY source, target', chunk
+                    )
+                    rows.extend(cursor.fetchall())
+            for source, target in rows:
+                links.setdefault(source, []).append(target)
+        finally:
+            cursor.close()
+        return links
+
+    def linked_from(self, keys):
+        '''
+        Map of each of keys to the content row ids that link to it, using the index on target
+        '''
+        linked = {}
+        keys = list(keys)
+        for start in range(0, len(keys), 500):
+            query = self.db(self.db.link.target.belongs(keys[start:start + 500]))
+            for record in query.select(self.db.link.source, self.db.link.target):
+                linked.setdefault(record.target, []).append(record.source)
+        return linked
+
+    def content_id_map(self):
+        '''
+        Confluence id to row id for all content, loaded once so ingest never has to look up parents
+        '''
+        if self.content_ids is None:
+            self.content_ids = {
+                r.id_: r.id for r in self.db(self.db.content).select(self.db.content.id, self.db.content.id_)
+            }
+        return self.content_ids
+
+    def attachment_row_map(self):
+        if self.attachment_rows is None:
+            self.attachment_rows = {
+                r.id_: r for r in self.db(self.db.attachment).select(
+                    self.db.attachment.id, self.db.attachment.id_, self.db.attachment.version,
+                    self.db.attachment.sha256, self.db.attachment.path_current, self.db.attachment.title
+                )
+            }
+        return self.attachment_rows
+
+    def blob_path(self, digest):
+        return Path(self.blob_dir, digest[0:2], digest)
+
+    def incoming_path(self, attachment_id, version):
+        return Path(self.incoming_dir, f'{attachment_id}-{version}')
+
+    def file_sha256(self, path):
+        digest = hashlib.sha256()
+        with open(path, 'rb') as fh:
+            for chunk in iter(lambda: fh.read(1024 * 1024), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def adopt_blob(self, path, digest):
+        '''
+        Move a complete file into the blob store, or drop it if we already hold identical content
+        '''
+        blob_path = self.blob_path(digest)
+        if blob_path.exists():
+            logger.debug('%s is a duplicate of %s', path, blob_path.relative_to(self.data_dir))
+            path.unlink()
+        else:
+            blob_path.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(path, blob_path)
+        return blob_path
+
+    def store_blob(self, attachment_id, digest):
+        record = self.attachment_row_map()[attachment_id]
+        blob_path = self.adopt_blob(self.incoming_path(attachment_id, record.version), digest)
+        logger.info('stored attachment %s (%s) as %s', attachment_id, record.title, digest)
+        record.sha256, record.path_current = digest, str(blob_path.relative_to(self.data_dir))
+        self.db(self.db.attachment.id==record.id).update(sha256=record.sha256, path_current=record.path_current)
+
+    def prune_blobs(self):
+        if not self.blob_dir.exists():
+            return
+        referenced = set(r.sha256 for r in self.db(self.db.attachment.sha256 != None).select(self.db.attachment.sha256))
+        for blob_path in self.blob_dir.glob('*/*'):
+            if blob_path.name not in referenced:
+                logger.debug('removing unreferenced blob %s', blob_path.name)
+                blob_path.unlink()
+
+    def compact(self):
+        '''
+        Move content stored as full json by older versions over to the meta and body columns
+        '''
+        query = self.db((self.db.content.meta == None) & (self.db.content.json != None))
+        records = query.select(self.db.content.id, self.db.content.json)
+        for record in records:
+            meta, body = compact(loads(record.json))
+            self.db(self.db.content.id==record.id).update(meta=meta, body=body, json=None)
+        return len(records)
+
+    def load_index(self, with_json=False):
+        '''
+        Load all content and attachments in two queries, see ContentIndex. Without with_json these are
+        raw queries returning ContentRecord and AttachmentRecord objects, leaving the stored json, meta
+        and body behind (use iter_content() to stream them when needed). With it, pydal Rows.
+        '''
+        if with_json:
+            contents = self.db(self.db.content).select(orderby=self.db.content.level|self.db.content.id)
+            attachments = self.db(self.db.attachment).select(orderby=self.db.attachment.id)
+            return ContentIndex(contents, attachments)
+        cursor = self.db._adapter.connection.cursor()
+        try:
+            cursor.execute(f'{ContentRecord.select("content")} ORDER BY level, id')
+            contents = [ContentRecord.from_row(row) for row in cursor]
+            cursor.execute(f'{AttachmentRecord.select("attachment")} ORDER BY id')
+            attachments = [AttachmentRecord.from_row(row) for row in cursor]
+        finally:
+            cursor.close()
+        return ContentIndex(contents, attachments)
+
+    def iter_content(self, ids=None):
+        '''
+        Stream (id_, meta, body, json) for all content (or just that in ids) from a cursor of its own,
+        one row at a time. Pass the last three to compact.stored_content() to read them.
+        '''
+        cursor = self.db._adapter.connection.cursor()
+        try:
+            if ids is None:
+                cursor.execute('SELECT id_, meta, body, json FROM content')
+                yield from cursor
+                return
+            ids = list(ids)
+            for start in range(0, len(ids), 500):
+                chunk = ids[start:start + 500]
+                cursor.execute(
+                    f'SELECT id_, meta, body, json FROM content WHERE id_ IN ({",".join("?" * len(chunk))})', chunk
+                )
+                yield from cursor.fetchall()
+        finally:
+            cursor.close()
+
     def iter_pages(self, min_level=0, max_level=1000):
-        query = self.db(
-            (self.db.content.type=='page')&
-            (self.db.content.level >= min_level)&
-            (self.db.content.level <= max_level)
-        )
-        for record in query.select(orderby=self.db.content.level):
-            yield (record, list(self.db(self.db.attachment.parent==record.id).select()))
+        yield from self.load_index(with_json=True).pages(min_level=min_level, max_level=max_level)
 
     def iter_blog(self):
-        query = self.db((self.db.content.type=='blogpost'))
-        for record in query.select(orderby=self.db.content.level):
-            yield (record, list(self.db(self.db.attachment.parent==record.id).select()))
+        yield from self.load_index(with_json=True).blog()
 
-    def store_content(self, content):
-        if not self.validate_dict(content):
-            raise ValueError('expecting a dictionary from Slurp')
-        record = self.db(self.db.content.id_==content['id']).select().first()
-        if record is None:
-            logger.debug('creating new record for %s (%s)', content['id'], content['title'])
-            record = self.db.content[self.db.content.insert(id_=content['id'])]
-        else:
-            logger.debug('record id is %s for %s (%s)', record.id, content['id'], content['title'])
-        record.update_record(
+    def content_versions(self):
+        '''
+        Map of content id_ to (version, {attachment id_: version}) for everything we have stored,
+        used by Slurp to decide what needs fetching again.
+        '''
+        attachments = {}
+        for record in self.db(self.db.attachment).select(
+            self.db.attachment.parent, self.db.attachment.id_, self.db.attachment.version
+        ):
+            attachments.setdefault(record.parent, {})[record.id_] = record.version
+        return {
+            record.id_: (record.version, attachments.get(record.id, {}))
+            for record in self.db(self.db.content).select(
+                self.db.content.id, self.db.content.id_, self.db.content.version
+            )
+        }
+
+    def touch_content(self, content):
+        '''
+        Mark unchanged content (and its attachments) as seen in this run so commit() keeps it.
+        Moving a page or changing its labels does not bump the version, so we refresh those too.
+        '''
+        content_ids = self.content_id_map()
+        if content['id'] not in content_ids:
+            raise ValueError(f'cannot touch {content["id"]}, it has not been stored')
+        record_id = content_ids[content['id']]
+        self.db(self.db.content.id==record_id).update(
             run=self.instance_id,
-            json=dumps(content['json']),
             level=content.get('level', None),
-            title=content['title'],
-            slug=slugify(content['title']),
-            version=content['version'],
-            created=pendulum.parse(content['json']['history']['createdDate']),
-            modified=pendulum.parse(content['json']['version']['when']),
-            parent=self.db(self.db.content.id_==content.get('parent', None)).select().first(),
-            labels=content['labels'],
-            deleted=False,
-            type=content['json']['type']
+            parent=content_ids.get(content.get('parent', None)),
+            labels=content['labels']
         )
+        self.db(self.db.attachment.parent==record_id).update(run=self.instance_id)
+
+    def keep_content_type(self, content_type):
+        '''
+        Mark all content of content_type (and its attachments) as seen in this run, for when Slurp
+        is only fetching some of it
+        '''
+        query = self.db(self.db.content.type==content_type)
+        query.update(run=self.instance_id)
+        self.db(self.db.attachment.parent.belongs(query._select(self.db.content.id))).update(run=self.instance_id)
+
+    def store_content(self, content):
+        self.store_contents([content])
+
+    def store_contents(self, contents):
+        '''
+        Upsert a batch of content, parents must come before (or be already stored ahead of) their children
+        '''
+        content_ids = self.content_id_map()
+        for content in contents:
+            if not self.validate_dict(content):
+                raise ValueError('expecting a dictionary from Slurp')
+            meta, body = compact(content['json'])
+            fields = dict(
+                run=self.instance_id,
+                json=None,
+                meta=meta,
+                body=body,
+                level=content.get('level', None),
+                title=content['title'],
+                slug=slugify(content['title']),
+                version=content['version'],
+                created=pendulum.parse(content['json']['history']['createdDate']),
+                modified=pendulum.parse(content['json']['version']['when']),
+                parent=content_ids.get(content.get('parent', None)),
+                labels=content['labels'],
+                deleted=False,
+                type=content['json']['type']
+            )
+            if content['id'] in content_ids:
+                logger.debug('record id is %s for %s (%s)', content_ids[content['id']], content['id'], content['title'])
+                self.db(self.db.content.id==content_ids[content['id']]).update(**fields)
+            else:
+                logger.debug('creating new record for %s (%s)', content['id'], content['title'])
+                content_ids[content['id']] = self.db.content.insert(id_=content['id'], **fields)
+            self.store_links(content_ids[content['id']], link_keys(content['json']), content['version'])
+
+    def store_attachments(self, content, attachments):
+        return [self.store_attachment(content, attachment) for attachment in attachments]
 
     def store_attachment(self, content, attachment):
+        '''
+        Record an attachment, returning the path it should be downloaded to if we don't already hold
+        this version of it in the blob store. Once downloaded, store_blob() links the record to its blob.
+        '''
         if not self.validate_dict(content) or not self.validate_dict(attachment):
             raise ValueError('expecting two dictionaries from Slurp')
-        path_all = Path(self.data_dir, 'attachments', attachment['id'])
-        path_version = Path(path_all, str(attachment['version']))
-        path_current = Path(path_version, attachment['title'])
-        path_version.mkdir(exist_ok=True, parents=True)
-
-        if path_current.exists():
-            if path_current.stat().st_size != attachment['json']['extensions']['fileSize']:
-                logger.debug('deleting %s (%s) because it is the wrong size', attachment['id'], attachment['title'])
-                path_current.unlink()
-
-        if not path_current.exists():
-            with open(path_current, 'wb') as f:
-                for chunk in attachment['stream']().iter_content(chunk_size=1024): 
-                    if chunk: # filter out keep-alives
-                        f.write(chunk)
-            logger.info('downloaded attachment: %s', path_current.relative_to(self.data_dir))
-
-        record = self.db(self.db.attachment.id_==attachment['id']).select().first()
-        if record is None:
-            logger.debug('creating new record for %s (%s)', attachment['id'], attachment['title'])
-            record = self.db.attachment[self.db.attachment.insert(id_=attachment['id'])]
-        record.update_record(
+
+        attachment_rows = self.attachment_row_map()
+        record = attachment_rows.get(attachment['id'])
+        digest = None
+        if record is not None and record.version == attachment['version']:
+            if record.sha256 and self.blob_path(record.sha256).exists():
+                digest = record.sha256
+            elif record.path_current and Path(self.data_dir, record.path_current).exists():
+                # Attachment downloaded before the blob store existed, move it in rather than download it again
+                legacy_path = Path(self.data_dir, record.path_current)
+                if legacy_path.stat().st_size == attachment['size']:
+                    digest = self.file_sha256(legacy_path)
+                    self.adopt_blob(legacy_path, digest)
+
+        download_path = None
+        if digest is None:
+            logger.debug('queueing download of %s (%s)', attachment['id'], attachment['title'])
+            download_path = self.incoming_path(attachment['id'], attachment['version'])
+
+        fields = dict(
             run=self.instance_id,
             json=dumps(attachment['json']),
             title=attachment['title'],
             version=attachment['version'],
             created=pendulum.parse(attachment['json']['history']['createdDate']),
             modified=pendulum.parse(attachment['json']['version']['when']),
-            parent=self.db(self.db.content.id_==content['id']).select().first(),
-            path_all=path_all.relative_to(self.data_dir),
-            path_current=path_current.relative_to(self.data_dir),
+            parent=self.content_id_map().get(content['id']),
+            sha256=digest,
+            path_current=str(self.blob_path(digest).relative_to(self.data_dir)) if digest else None,
             deleted=False
-        )
\ No newline at end of file
+        )
+        if record is None:
+            logger.debug('creating new record for %s (%s)', attachment['id'], attachment['title'])
+            record_id = self.db.attachment.insert(id_=attachment['id'], **fields)
+        else:
+            record_id = record.id
+            self.db(self.db.attachment.id==record_id).update(**fields)
+        attachment_rows[attachment['id']] = SimpleNamespace(
+            id=record_id, id_=attachment['id'], version=fields['version'], title=fields['title'],
+            sha256=fields['sha256'], path_current=fields['path_current']
+        )
+        return download_path
@@ -0,0 +1,176 @@
+import re
+import logging
+from pathlib import Path
+import lxml.html
+from .massage import Document
+
+logger = logging.getLogger(f'{__package__}.{__name__}')
+
+
+class Transform(Document):
+    '''
+    Single pass replacement for Massage. The document is parsed once by lxml and every element
+    is visited once, running whichever rules are registered for its tag:
+
+        @Transform.rule('a')
+        def my_rule(transform, element):
+            ...
+
+    Rules may rewrite the element in place or call transform.remove(element) to drop it once
+    the walk has finished (its tail text is kept).
+
+    The output matches Massage's apart from what BeautifulSoup does when writing: attributes
+    are kept in document order rather than sorted, and whitespace between elements is left as
+    it was. benchmarks/massage.py checks the two agree otherwise.
+    '''
+    rules = {}
+
+    def __init__(self, content_json, label_list, destination, export_files, convert_to_index_html=False,
+                 derivatives=None):
+        super().__init__(content_json, label_list, destination, export_files)
+        self.convert_to_index_html = convert_to_index_html
+        self.derivatives = derivatives or {}  # See Export.derivatives
+        self.removals = []
+
+    @classmethod
+    def rule(cls, *tags):
+        def register(func):
+            for tag in tags:
+                cls.rules.setdefault(tag, []).append(func)
+            return func
+        return register
+
+    def remove(self, element):
+        self.removals.append(element)
+
+    def apply(self):
+        for element in self.document.iter():
+            for rule in self.rules.get(element.tag, ()):
+                rule(self, element)
+        for element in self.removals:
+            element.drop_tree()
+        self.removals = []
+        return self
+
+    def generate_html(self):
+        return lxml.html.tostring(self.document, encoding='unicode')
+
+    def generate_body(self):
+        '''
+        Just the inner HTML of <body>, for readers that take their metadata from elsewhere
+        '''
+        body = self.document.body
+        return (body.text or '') + ''.join(lxml.html.tostring(child, encoding='unicode') for child in body)
+
+
+@Transform.rule('style')
+def remove_styles(transform, style):
+    transform.remove(style)
+
+
+@Transform.rule('a')
+def convert_page_links(transform, a):
+    '''
+    See Massage.convert_page_links()
+    '''
+    href = a.get('href', '')
+    if 'viewpage.action?pageId=' in href:
+        content_id = href.split('pageId=')[-1].split('&')[0]
+        if content_id not in transform.export_files:
+            logger.warning('Broken link to page %s in %s', content_id, transform.destination)
+            return
+        href = str(Path('/', transform.export_files[content_id]))
+        if transform.convert_to_index_html:
+            if href.endswith('.html'):
+                href = href[0:-5] + '/'
+            if href.startswith('/pages/'):
+                href = href[6:]
+        a.set('href', href)
+
+
+CULL_PROPERTIES = [
+    'data-linked-resource-container-id',
+    'data-linked-resource-container-version',
+    'data-linked-resource-content-type',
+    'data-linked-resource-default-alias',
+    'data-linked-resource-id',
+    'data-linked-resource-type',
+    'data-linked-resource-version',
+    'data-nice-type'
+]
+
+
+@Transform.rule('a')
+def convert_attachment_links(transform, a):
+    '''
+    See Massage.convert_attachment_links()
+    '''
+    if '/download/attachments/' in a.get('href', ''):
+        key = f'att{a.get("data-linked-resource-id")}'
+        if key in transform.export_files:
+            a.set('href', transform.relative_path(Path(transform.export_files[key])))
+        else:
+            logger.warning('Broken link to attachment %s in %s', key, transform.destination)
+    for cull_prop in CULL_PROPERTIES:
+        a.attrib.pop(cull_prop, None)
+
+
+@Transform.rule('pre')
+def convert_code_to_prettyprint(transform, pre):
+    if 'syntaxhighlighter-pre' in pre.get('class', '').split():
+        params = dict(
+            re.split(': ?', s, maxsplit=1) for s in re.split('; ?', pre.get('data-syntaxhighlighter-params', '')) if ':' in s
+        )
+        classes = ['prettyprint']
+        if 'brush' in params:
+            classes.append(f'lang-{params["brush"]}')
+        pre.set('class', ' '.join(classes))
+
+
+@Transform.rule('span')
+def replace_embedded_image_wrappers(transform, span):
+    if 'confluence-embedded-file-wrapper' in span.get('class', '').split():
+        if next(span.iter('img'), None) is not None:
+            span.set('class', 'embedded-image')
+
+
+@Transform.rule('img')
+def replace_embedded_images(transform, image):
+    '''
+    See Massage.replace_embedded_images()
+    '''
+    image.attrib.pop('class', None)
+    src = image.get('src', '')
+    if 'download/attachments' in src:
+        href = src.split('/')[-1].split('?')[0]
+        try_keys = [f'{transform.content["id"]}/{href}', href]
+        for try_replace in try_keys:
+            if try_replace in transform.export_files:
+                image.set('src', image_url(transform.export_files[try_replace]))
+                set_srcset(image, transform.derivatives.get(str(transform.export_files[try_replace])))
+                break
+
+
+def image_url(path):
+    src = str(Path('/', path))
+    if src.startswith('/pages/'):
+        src = src[6:]
+    return src
+
+
+def set_srcset(image, derivatives):
+    '''
+    Offer the resized copies of an image (see images.ImageStage), sized to how Confluence displays it
+    '''
+    if not derivatives:
+        return
+    image.set('srcset', ', '.join(f'{image_url(path)} {width}w' for width, _, path in derivatives))
+    full_width, full_height, _ = derivatives[-1]
+    shown_width = None
+    if image.get('width', '').isdigit():
+        shown_width = int(image.get('width'))
+    elif image.get('height', '').isdigit():
+        shown_width = round(int(image.get('height')) * full_width / full_height)
+    if shown_width:
+        image.set('sizes', f'{min(shown_width, full_width)}px')
+    image.set('loading', 'lazy')
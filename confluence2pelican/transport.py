@@ -0,0 +1,130 @@
+import re
+import time
+import random
+import logging
+import threading
+from email.utils import parsedate_to_datetime
+import requests
+from requests.adapters import HTTPAdapter
+from .metrics import metrics
+
+
+logger = logging.getLogger(f'{__package__}.{__name__}')
+
+
+class TokenBucket:
+    '''
+    Allow `rate` requests per second on average, with bursts of up to `burst`
+    '''
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst or max(1, rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class Transport:
+    '''
+    A pooled requests.Session that retries throttled and failed requests with exponential backoff
+    (honouring Retry-After), optionally rate limits them, and counts latency and errors per endpoint.
+    One Transport can be shared by the Slurps of several spaces.
+    '''
+    retry_statuses = (429, 500, 502, 503, 504)
+
+    def __init__(self, url, auth, pool_size=16, retries=5, backoff=0.5, max_backoff=60, rate=None, burst=None,
+                 max_in_flight=None):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.limiter = TokenBucket(rate, burst) if rate else None
+        # Requests waiting on Confluence at once, across every Slurp sharing this Transport. Streamed
+        # downloads count until their headers arrive, not while the body is read.
+        self.in_flight = threading.BoundedSemaphore(max_in_flight) if max_in_flight else None
+        self.session = requests.Session()
+        self.session.auth = auth
+        self.session.headers['Accept-Encoding'] = 'gzip, deflate'
+        self.session.mount(url, HTTPAdapter(pool_connections=4, pool_maxsize=pool_size))
+        self.stats = {}
+        self.stats_lock = threading.Lock()
+
+    def endpoint(self, url):
+        '''
+        Group urls for the stats, e.g. .../rest/api/content/12345?expand=... becomes rest/api/content/{id}
+        '''
+        path = url.split('?')[0]
+        path = re.sub(r'^https?://[^/]+', '', path)
+        path = re.sub(r'/download/attachments/.*', '/download/attachments/{file}', path)
+        return re.sub(r'/\d+(?=/|$)', '/{id}', path).lstrip('/')
+
+    def record(self, endpoint, seconds, ok):
+        with self.stats_lock:
+            stats = self.stats.setdefault(endpoint, {'requests': 0, 'errors': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+            stats['requests'] += 1
+            stats['errors'] += 0 if ok else 1
+            stats['seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+
+    def retry_delay(self, res, attempt):
+        retry_after = res.headers.get('Retry-After') if res is not None else None
+        if retry_after:
+            try:
+                return min(self.max_backoff, max(0.0, float(retry_after)))
+            except ValueError:
+                try:
+                    return min(self.max_backoff, max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time()))
+                except (TypeError, ValueError):
+                    pass
+        return min(self.max_backoff, self.backoff * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+    def get(self, url, **kwargs):
+        endpoint = self.endpoint(url)
+        for attempt in range(self.retries + 1):
+            if self.limiter:
+                self.limiter.acquire()
+            start = time.monotonic()
+            res, error = None, None
+            if self.in_flight:
+                self.in_flight.acquire()
+            try:
+                res = self.session.get(url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            finally:
+                if self.in_flight:
+                    self.in_flight.release()
+            ok = res is not None and res.status_code not in self.retry_statuses
+            self.record(endpoint, time.monotonic() - start, ok and res.status_code < 400)
+            if ok or attempt == self.retries:
+                break
+            delay = self.retry_delay(res, attempt)
+            logger.warning(
+                'GET %s failed (%s), retrying in %.1fs', endpoint, error or f'HTTP {res.status_code}', delay
+            )
+            if res is not None:
+                res.close()
+            time.sleep(delay)
+        if res is None:
+            raise error
+        if not kwargs.get('stream'):
+            metrics.count('http.bytes', len(res.content))
+        return res
+
+    def report(self):
+        with self.stats_lock:
+            return {
+                endpoint: dict(stats, mean_seconds=stats['seconds'] / stats['requests'])
+                for endpoint, stats in sorted(self.stats.items())
+            }
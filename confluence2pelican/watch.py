@@ -0,0 +1,114 @@
+import math
+import time
+import logging
+import subprocess
+from .metrics import metrics as default_metrics
+
+
+logger = logging.getLogger(f'{__package__}.{__name__}')
+
+
+class Watcher:
+    '''
+    Keep Slurp, Store and Export alive and poll Confluence for recently modified content.
+    A burst of edits is collected until nothing new has turned up for `debounce` seconds (or
+    `max_delay` has passed since the first), then only that content is slurped again and
+    exported. Export's fingerprints take care of re-rendering pages that link to anything
+    that moved, and it keeps the link map in memory between rebuilds, re-reading only the
+    rows the Store has changed (the metadata index is cheap enough to re-read each time).
+    Every `full_every` seconds an incremental slurp catches deletions and attachment
+    changes, which don't show up in the poll.
+    '''
+    def __init__(self, slurp, store, export, interval=10, debounce=5, max_delay=60, full_every=3600, command=None,
+                 metrics_file=None, metrics=None):
+        self.slurp = slurp
+        self.store = store
+        self.export = export
+        self.interval = interval
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.full_every = full_every
+        self.command = command
+        self.metrics_file = metrics_file  # Rewritten after every rebuild, run() never returns
+        self.metrics = metrics or default_metrics
+        self.rebuilds = 0
+        self.homepage_id = None
+        self.versions = {}
+        self.pending = {}
+        self.first_change = None
+        self.last_change = None
+
+    def load_versions(self):
+        self.versions = {content_id: version for content_id, (version, _) in self.store.content_versions().items()}
+
+    def poll(self, since):
+        '''
+        Queue anything modified since (a time.time()) that we don't already hold that version of
+        '''
+        minutes = max(1, math.ceil((time.time() - since) / 60)) + 1
+        for listed in self.slurp.recently_modified(minutes, self.homepage_id):
+            if self.versions.get(listed['id']) == listed['version']:
+                continue
+            if self.pending.get(listed['id'], {}).get('version') == listed['version']:
+                continue
+            logger.info('%s (%s) changed, now at version %d', listed['id'], listed['title'], listed['version'])
+            self.pending[listed['id']] = listed
+            now = time.monotonic()
+            self.first_change = self.first_change or now
+            self.last_change = now
+
+    def settled(self):
+        if not self.pending:
+            return False
+        now = time.monotonic()
+        return now - self.last_change >= self.debounce or now - self.first_change >= self.max_delay
+
+    def rebuild(self, full=False):
+        '''
+        Slurp (just what's pending, or everything incrementally) and export, timed for this watcher
+        alone as other spaces' watchers share the module level metrics
+        '''
+        items = 'everything' if full else f'{len(self.pending)} changed items'
+        timings = {}
+        start = time.perf_counter()
+        if full:
+            self.slurp.slurp(store=self.store, incremental=True)
+            self.load_versions()
+        else:
+            contents = self.slurp.refresh(self.store, self.pending.values())
+            self.versions.update((content['id'], content['version']) for content in contents)
+        timings['slurp'] = time.perf_counter() - start
+        self.export.export(store=self.store)
+        timings['export'] = time.perf_counter() - start - timings['slurp']
+        if self.command:
+            subprocess.run(self.command, shell=True, check=False)
+            timings['command'] = time.perf_counter() - start - timings['slurp'] - timings['export']
+        timings['total'] = time.perf_counter() - start
+        logger.info('Rebuilt %s in %.1fs', items, timings['total'])
+        self.pending = {}
+        self.first_change = self.last_change = None
+        self.rebuilds += 1
+        self.metrics.count('watch.rebuilds')
+        if self.metrics_file:
+            self.metrics.write(self.metrics_file, watch={
+                'rebuilds': self.rebuilds,
+                'last_rebuild': dict(timings, items=items, full=full, finished=time.time())
+            })
+
+    def run(self):
+        self.homepage_id = self.slurp.get_homepage_id()
+        self.load_versions()
+        last_poll = last_full = time.time()
+        while True:
+            poll_started = time.time()
+            try:
+                self.poll(last_poll)
+                last_poll = poll_started
+                if self.settled():
+                    self.rebuild()
+                elif not self.pending and poll_started - last_full >= self.full_every:
+                    self.rebuild(full=True)
+                    last_full = poll_started
+            except Exception:
+                logger.exception('Watch cycle failed, trying again in %ds', self.interval)
+            time.sleep(self.interval if not self.pending else min(self.interval, self.debounce))
@@ -0,0 +1,102 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import logging
+from pelican import signals
+from pelican.contents import Article, Page
+from pelican.readers import BaseReader, default_metadata, path_metadata, parse_path_metadata
+try:
+    from pelican.readers import _filter_discardable_metadata as filter_discardable
+except ImportError:
+    def filter_discardable(metadata):
+        return metadata
+from pelican.utils import order_content
+
+'''
+This plugin reads pages and blog posts straight out of the confluence2pelican Store rather
+than from HTML files in PATH. Run the export with `--target store` so the massaged HTML is
+saved to the Store, and set CONFLUENCE_STORE to the path of its SQLite database.
+
+Each item is given the source path its HTML file would have had, so page_hierarchy and
+everything else that works from paths behaves the same as it does with exported files.
+'''
+
+logger = logging.getLogger(__name__)
+string_unpack = re.compile(r'(?<!\|)\|(?!\|)')  # How pydal stores list:string fields
+
+
+def decode_list(value):
+    if not value:
+        return []
+    return [item.replace('||', '|') for item in string_unpack.split(value[1:-1]) if item.strip()]
+
+
+def read_store(settings, content_type):
+    store_path = settings.get('CONFLUENCE_STORE')
+    if not store_path or not os.path.exists(store_path):
+        return []
+    db = sqlite3.connect(f'file:{store_path}?mode=ro', uri=True)
+    db.row_factory = sqlite3.Row
+    try:
+        return db.execute(
+            'SELECT title, labels, meta, json, html, path FROM content '
+            'WHERE type = ? AND html IS NOT NULL AND path IS NOT NULL',
+            (content_type, )
+        ).fetchall()
+    finally:
+        db.close()
+
+
+def build_content(generator, content_class, content_type):
+    start = time.perf_counter()
+    reader = BaseReader(generator.settings)
+    items = []
+    for row in read_store(generator.settings, content_type):
+        meta = json.loads(row['meta'] or row['json'])
+        labels = [l for l in decode_list(row['labels']) if l not in ('hidden', 'menu')]
+        # Built the way Pelican's own Readers.read_file() does, so e.g. USE_FOLDER_AS_CATEGORY still applies
+        full_path = os.path.join(generator.path, row['path'])
+        source_path = os.path.relpath(full_path, generator.path).replace(os.sep, '/')
+        metadata = filter_discardable(default_metadata(generator.settings, reader.process_metadata))
+        metadata.update(path_metadata(full_path, source_path, generator.settings))
+        metadata.update(filter_discardable(
+            parse_path_metadata(source_path, generator.settings, reader.process_metadata)
+        ))
+        for name, value in (
+            ('title', row['title']),
+            ('date', meta['history']['createdDate']),
+            ('modified', meta['version']['when']),
+            ('tags', ','.join(labels)),
+            ('authors', meta['history']['createdBy']['username']),
+        ):
+            if value:
+                metadata[name] = reader.process_metadata(name, value)
+        items.append(content_class(
+            row['html'],
+            metadata=metadata,
+            settings=generator.settings,
+            source_path=full_path,
+            context=generator.context
+        ))
+    logger.info(
+        'confluence_reader: read %d %s from the store in %.3fs',
+        len(items), content_type, time.perf_counter() - start
+    )
+    return items
+
+
+def add_pages(generator):
+    generator.pages.extend(build_content(generator, Page, 'page'))
+    generator.pages[:] = order_content(generator.pages, generator.settings['PAGE_ORDER_BY'])
+
+
+def add_articles(generator):
+    generator.articles.extend(build_content(generator, Article, 'blogpost'))
+    generator.articles[:] = order_content(generator.articles, generator.settings['ARTICLE_ORDER_BY'])
+
+
+def register():
+    signals.page_generator_finalized.connect(add_pages)
+    signals.article_generator_pretaxonomy.connect(add_articles)
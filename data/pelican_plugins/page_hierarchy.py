@@ -1,5 +1,7 @@
 # Totally stole this from: https://github.com/akhayyat/pelican-page-hierarchy
 
+import time
+import logging
 from pelican import signals, contents
 from os.path import splitext, dirname
 
@@ -12,6 +14,9 @@ hierarchy, the slug of each page is forced to be the path of its source
 file.
 '''
 
+logger = logging.getLogger(__name__)
+
+
 def get_path(page, settings):
     '''
     if a 'path' is defined in PATH_METADATA, extract it. otherwise,
@@ -46,27 +51,39 @@ def override_metadata(content_object):
             content_object.override_url = current_url[6:]
 
 def set_relationships(generator):
-    # initialize parents and children lists
+    start = time.perf_counter()
+
+    # initialize parents and children lists, and index pages by url
+    pages_by_url = {}
     for page in generator.pages:
         page.parent = None
         page.parents = []
         page.children = []
+        pages_by_url[page.url] = page
 
     # set immediate parents and children
     for page in generator.pages:
         parent_url = dirname(dirname(page.url))
         if parent_url: parent_url += '/'
-        for page2 in generator.pages:
-            if page2.url == parent_url and page2 != page:
-                page.parent = page2
-                page2.children.append(page)
+        parent = pages_by_url.get(parent_url)
+        if parent is not None and parent is not page:
+            page.parent = parent
+            parent.children.append(page)
+
+    # set all parents (ancestors), reusing the ancestors already worked out for each parent
+    ancestors = {}
+    def get_ancestors(page):
+        if id(page) not in ancestors:
+            ancestors[id(page)] = get_ancestors(page.parent) + [page.parent] if page.parent else []
+        return ancestors[id(page)]
 
-    # set all parents (ancestors)
     for page in generator.pages:
-        p = page
-        while p.parent:
-            page.parents.insert(0, p.parent)
-            p = p.parent
+        page.parents = list(get_ancestors(page))
+
+    logger.info(
+        'page_hierarchy: set relationships for %d pages in %.3fs',
+        len(generator.pages), time.perf_counter() - start
+    )
 
 
 def register():
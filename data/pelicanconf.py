@@ -3,7 +3,11 @@
 from __future__ import unicode_literals
 from pathlib import Path
 import json
-data_dir = Path(__file__).parent.resolve()
+import os
+conf_dir = Path(__file__).parent.resolve()
+# With several confluence_space keys each space is exported to data/spaces/<key>, build one with e.g.
+#   CONFLUENCE2PELICAN_DATA=data/spaces/WWW pelican -s data/pelicanconf.py
+data_dir = Path(os.environ.get('CONFLUENCE2PELICAN_DATA', conf_dir)).resolve()
 
 AUTHOR = 'KBNi'
 SITENAME = 'KBNi'
@@ -11,12 +15,13 @@ SITEURL = 'https://kbni.net.au'
 TIMEZONE = 'Australia/Sydney'
 DEFAULT_DATE_FORMAT = '%Y-%m-%d'
 
-PLUGIN_PATHS = [str(Path(data_dir, 'pelican_plugins')), ]
-PLUGINS = ['page_hierarchy']
-THEME = str(Path(data_dir, 'theme'))
+PLUGIN_PATHS = [str(Path(conf_dir, 'pelican_plugins')), ]
+PLUGINS = ['confluence_reader', 'page_hierarchy']
+THEME = str(Path(conf_dir, 'theme'))
 PATH = str(Path(data_dir, 'exports'))
 OUTPUT_PATH = str(Path(data_dir, 'output'))
 STATIC_PATHS = [PATH, ]
+CONFLUENCE_STORE = str(Path(data_dir, 'store_db', 'store.sqlite'))  # Used with `--target store`
 ARTICLE_URL = 'posts/{date:%Y}/{date:%m}/{date:%d}/{slug}/'
 ARTICLE_SAVE_AS = 'posts/{date:%Y}/{date:%m}/{date:%d}/{slug}/index.html'
 TAGS_SAVE_AS = 'tags/index.html'
@@ -25,6 +30,12 @@ TAG_SAVE_AS = 'tags/{slug}/index.html'
 TAG_URL = 'tags/{slug}/'
 DELETE_OUTPUT_DIRECTORY =True
 
+# confluence2pelican only rewrites exports that changed, so let Pelican reuse what it parsed last time
+CACHE_CONTENT = True
+LOAD_CONTENT_CACHE = True
+CHECK_MODIFIED_METHOD = 'mtime'
+CACHE_PATH = str(Path(data_dir, 'cache'))
+
 CATEGORY_URL = 'category/{slug}/'
 CATEGORY_SAVE_AS = 'category/{slug}/index.html'
 YEAR_ARCHIVE_SAVE_AS = 'posts/{date:%Y}/index.html'
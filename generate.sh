@@ -3,9 +3,17 @@
 set -e                  # exit script if errors are encountered
 cd "$(dirname "$0")"   # cd to where this script lives
 
-# Retreieve all our Confluence content and export it for processing by Pelican
-python -m confluence2pelican -es
+# Retreieve new and changed Confluence content and export it for processing by Pelican
+python -m confluence2pelican -esi
 
-# Run pelican to process the exported output and pass any arguments here
-pelican -r -s data/pelicanconf.py --ignore-cache "$@"
+# With several spaces (see confluence_space in settings.json) each is exported to data/spaces/<KEY>/,
+# build them one after another (without --autoreload, which would never return)
+if [ -d ./data/spaces ]; then
+    for space_dir in ./data/spaces/*/; do
+        CONFLUENCE2PELICAN_DATA="$space_dir" pelican -s data/pelicanconf.py "$@"
+    done
+    exit 0
+fi
 
+# Run pelican to process the exported output and pass any arguments here
+pelican -r -s data/pelicanconf.py "$@"
@@ -3,6 +3,39 @@
 set -e                  # exit script if errors are encountered
 cd "$(dirname "$0")"   # cd to where this script lives
 
-# Publish using rclone
-rclone -v sync ./data/output kbni-net-au:kbni.net.au
+# Work out which files in data/output changed since the last publish (lists are written to data/publish/)
+python -m confluence2pelican -m
 
+# Publish a data directory's output using rclone, only sending what changed since the last publish
+# when we know what that is
+publish() {
+    local data_dir="$1" remote="$2"
+    if [ -f "$data_dir/published_manifest.json" ] && [ -f "$data_dir/publish/upload.txt" ]; then
+        if [ -s "$data_dir/publish/upload.txt" ]; then
+            rclone -v copy --no-traverse --files-from "$data_dir/publish/upload.txt" "$data_dir/output" "$remote"
+        fi
+        if [ -s "$data_dir/publish/removed.txt" ]; then
+            rclone -v delete --files-from "$data_dir/publish/removed.txt" "$remote"
+        fi
+    else
+        rclone -v sync "$data_dir/output" "$remote"
+    fi
+
+    # What's live now is the baseline for the next publish
+    if [ -f "$data_dir/output_manifest.json" ]; then
+        cp "$data_dir/output_manifest.json" "$data_dir/published_manifest.json"
+    fi
+}
+
+# With several spaces each one's output goes to the rclone remote named in data/spaces/<KEY>/rclone_remote
+if [ -d ./data/spaces ]; then
+    for space_dir in ./data/spaces/*; do
+        if [ ! -f "$space_dir/rclone_remote" ]; then
+            echo "Not publishing $space_dir, it has no rclone_remote file" >&2
+            continue
+        fi
+        publish "$space_dir" "$(cat "$space_dir/rclone_remote")"
+    done
+else
+    publish ./data kbni-net-au:kbni.net.au
+fi